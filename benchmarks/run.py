@@ -0,0 +1,413 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import stat
+import sys
+import tempfile
+from pathlib import Path
+from time import monotonic, sleep, strftime
+
+from psutil import Process, disk_partitions
+
+SHAPES = ("tiny", "huge", "mixed", "deep")
+WORDS = [
+    "ram",
+    "disk",
+    "cache",
+    "backup",
+    "restore",
+    "target",
+    "profile",
+    "session",
+    "index",
+    "chunk",
+    "frame",
+    "level",
+]
+
+
+def main():
+    args = parse_args()
+    work = Path(tempfile.mkdtemp(prefix="ramifier-bench-", dir=args.dir))
+    for name in ("XDG_CONFIG_HOME", "XDG_STATE_HOME", "XDG_DATA_HOME"):
+        os.environ[name] = str(work / name.lower())
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+    try:
+        results = run(args, work)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    report = {
+        "created": strftime("%Y-%m-%dT%H:%M:%S"),
+        "version": results.pop(0),
+        "python": platform.python_version(),
+        "kernel": platform.release(),
+        "cpus": os.cpu_count(),
+        "dir": str(args.dir or tempfile.gettempdir()),
+        "tmpfs": is_tmpfs(work.parent),
+        "scale": args.scale,
+        "results": results,
+    }
+    print_results(results)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=4) + "\n")
+    if args.compare:
+        compare(json.loads(args.compare.read_text()), report)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark ramifier hot paths")
+    parser.add_argument("--dir", type=Path, help="working directory (tmpfs or disk)")
+    parser.add_argument("--ram-dir", type=Path, help="RAM directory for moves")
+    parser.add_argument("--output", type=Path, help="write JSON results to a file")
+    parser.add_argument("--compare", type=Path, help="compare with a JSON result")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shapes", default=",".join(SHAPES))
+    parser.add_argument("--levels", default="1,3,9")
+    parser.add_argument("--threads", default="0,4")
+    return parser.parse_args()
+
+
+def run(args: argparse.Namespace, work: Path) -> list:
+    from ramifier import __version__
+    from ramifier.log import logger
+
+    logger.setLevel(logging.WARNING)
+    results = [__version__]
+    shm = Path("/dev/shm")
+    ram_dir = Path(
+        tempfile.mkdtemp(
+            prefix="ramifier-bench-",
+            dir=args.ram_dir or (shm if is_tmpfs(shm) else None),
+        )
+    )
+    try:
+        results.append(check_chain(work))
+        for shape in args.shapes.split(","):
+            path = work / "trees" / shape
+            generate(shape, path, args.scale, random.Random(args.seed))
+            results.append(bench_hash(shape, path))
+            target = make_target(f"backup-{shape}", path, work)
+            for level in map(int, args.levels.split(",")):
+                for threads in map(int, args.threads.split(",")):
+                    results.append(bench_backup(shape, target, level, threads))
+            results.append(bench_restore(shape, target, work))
+            results.extend(bench_move(shape, path, work, ram_dir))
+    finally:
+        shutil.rmtree(ram_dir, ignore_errors=True)
+    return results
+
+
+def generate(shape: str, root: Path, scale: float, rng: random.Random):
+    root.mkdir(parents=True)
+    if shape == "tiny":
+        write_files(root, int(20000 * scale), 256, 4096, rng)
+    elif shape == "huge":
+        write_files(root, 4, int(64 * scale) << 20, int(64 * scale) << 20, rng)
+    elif shape == "mixed":
+        write_files(root, int(5000 * scale), 1024, 64 << 10, rng)
+        write_files(root / "large", 8, int(8 * scale) << 20, int(16 * scale) << 20, rng)
+    elif shape == "deep":
+        for i in range(int(200 * scale)):
+            path = root.joinpath(*(f"d{rng.randrange(4)}" for _ in range(12)))
+            write_files(path, 10, 512, 8192, rng, f"{i}-")
+    else:
+        raise ValueError(f"Unknown shape: {shape}")
+
+
+def write_files(
+    root: Path, count: int, min_size: int, max_size: int, rng, prefix: str = ""
+):
+    root.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        size = rng.randint(min_size, max_size)
+        with (root / f"{prefix}{i}.dat").open("wb") as f_out:
+            f_out.write(make_data(size, rng))
+
+
+def make_data(size: int, rng: random.Random) -> bytes:
+    if rng.random() < 0.25:
+        return rng.randbytes(size)
+    text = " ".join(rng.choice(WORDS) for _ in range(64)).encode()
+    block = bytearray(text * (size // len(text) + 1))
+    for _ in range(size // 4096 + 1):
+        block[rng.randrange(size or 1)] = rng.randrange(256)
+    return bytes(block[:size])
+
+
+def make_target(name: str, path: Path, work: Path, **options):
+    from ramifier.target import Target
+
+    settings = {
+        "max_backups": 1,
+        "interval": {},
+        "compression_level": 3,
+        "compression_threads": 0,
+        "compression_budget": 0,
+        "compression_cpu_budget": 0,
+        "dictionary": False,
+        "dictionary_size": 112640,
+        "full_backup_every": 1,
+        "backend": "tar",
+        "chunk_store": None,
+        "restore_threads": 0,
+        "move_threads": 8,
+        "shutdown_mode": "copy",
+        "snapshot": False,
+        "exclude": [],
+        "include": [],
+        "catalog": True,
+        "lazy_restore": False,
+        "restore_priority": [],
+        "priority": 0,
+        "tiered": False,
+        "promote_threshold": 3,
+        "demote_after": 3,
+        "tier_interval": 300,
+        "tier_size": 0,
+        "ram_path": work / "ram" / name,
+    }
+    settings.update(options)
+    return Target(
+        name=name, path=str(path), backup_path=str(work / "backups" / name), **settings
+    )
+
+
+def bench_hash(shape: str, path: Path) -> dict:
+    from ramifier.changes import ChangeDetector
+
+    detector = ChangeDetector(path, f"hash-{shape}")
+    with Measure() as cold:
+        detector.state_hash()
+    with Measure() as warm:
+        detector.state_hash()
+    return result("hash", shape, path, cold, warm_seconds=round(warm.seconds, 4))
+
+
+def bench_backup(shape: str, target, level: int, threads: int) -> dict:
+    from ramifier.backup import backup_target
+    from ramifier.changes import get_detector
+    from ramifier.state import get_backups
+
+    target.compression_level = level
+    target.compression_threads = threads
+    get_detector(target).refresh()
+    with Measure() as measure:
+        backup_target(target, True)
+
+    output = Path(get_backups(target)[-1]["file"]).stat().st_size
+    return result(
+        "backup",
+        shape,
+        target.path,
+        measure,
+        level=level,
+        threads=threads,
+        output_bytes=output,
+        ratio=round(tree_size(target.path) / output, 3) if output else None,
+    )
+
+
+def bench_restore(shape: str, target, work: Path) -> dict:
+    from ramifier.backup import restore_target
+
+    dest = work / "restored" / shape
+    with Measure() as measure:
+        restore_target(target, lazy=False, root=dest)
+    shutil.rmtree(dest)
+    return result("restore", shape, target.path, measure)
+
+
+def check_chain(work: Path) -> dict:
+    from ramifier.backup import backup_target, restore_target
+    from ramifier.state import get_backups
+
+    path = work / "trees" / "chain"
+    (path / "dir").mkdir(parents=True)
+    (path / "gone" / "empty").mkdir(parents=True)
+    (path / "dir" / "file").write_text("full\n")
+    (path / "old").write_text("old\n")
+    target = make_target("chain", path, work, full_backup_every=4, max_backups=4)
+    backup_target(target, True)
+    sleep(1)
+
+    os.symlink("dir", path / "dir-link")
+    os.symlink("missing", path / "dangling")
+    (path / "new" / "empty").mkdir(parents=True)
+    os.chmod(path / "dir", 0o700)
+    shutil.rmtree(path / "gone")
+    (path / "old").unlink()
+    (path / "dir" / "file").write_text("incremental\n")
+    sleep(1)
+    backup_target(target)
+
+    (path / "dir-link").unlink()
+    os.symlink("new", path / "dir-link")
+    os.rmdir(path / "new" / "empty")
+    os.chmod(path / "new", 0o750)
+    os.chmod(path / "dir" / "file", 0o600)
+    sleep(1)
+    backup_target(target)
+
+    kinds = [backup.get("kind", "full") for backup in get_backups(target)]
+    if kinds != ["full", "incremental", "incremental"]:
+        raise RuntimeError(f"Unexpected backup chain: {kinds}")
+
+    dest = work / "restored" / "chain"
+    with Measure() as measure:
+        restore_target(target, lazy=False, root=dest)
+    expected = describe_tree(path)
+    restored = describe_tree(dest)
+    if restored != expected:
+        differs = sorted(
+            rel
+            for rel in expected.keys() | restored.keys()
+            if expected.get(rel) != restored.get(rel)
+        )
+        raise RuntimeError(f"Chain restore differs: {', '.join(differs)}")
+    shutil.rmtree(dest)
+    return result("chain_restore", "chain", path, measure, backups=len(kinds))
+
+
+def describe_tree(root: Path) -> dict:
+    tree = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        for name in dir_names + file_names:
+            path = os.path.join(dir_path, name)
+            path_stat = os.lstat(path)
+            mode = stat.S_IMODE(path_stat.st_mode)
+            if stat.S_ISLNK(path_stat.st_mode):
+                entry = ("symlink", os.readlink(path))
+            elif stat.S_ISDIR(path_stat.st_mode):
+                entry = ("dir", mode)
+            else:
+                entry = ("file", mode, Path(path).read_bytes())
+            tree[os.path.relpath(path, root)] = entry
+    return tree
+
+
+def bench_move(shape: str, path: Path, work: Path, ram_dir: Path) -> list:
+    from ramifier.runtime import create_symlink, remove_symlink
+
+    target = make_target(f"move-{shape}", path, work, ram_path=ram_dir / shape)
+    with Measure() as to_ram:
+        create_symlink(target)
+    with Measure() as to_disk:
+        remove_symlink(target)
+    return [
+        result("move_to_ram", shape, path, to_ram),
+        result("move_to_disk", shape, path, to_disk),
+    ]
+
+
+class Measure:
+    def __enter__(self):
+        reset_peak_rss()
+        self.process = Process()
+        self.written = self.process.io_counters().write_chars
+        self.started = monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = monotonic() - self.started
+        self.written = self.process.io_counters().write_chars - self.written
+        self.peak_rss = peak_rss()
+        return False
+
+
+def result(bench: str, shape: str, path: Path, measure: Measure, **extra) -> dict:
+    size = tree_size(path)
+    entry = {
+        "bench": bench,
+        "shape": shape,
+        "bytes": size,
+        "seconds": round(measure.seconds, 4),
+        "throughput_mib_s": round(size / (1 << 20) / max(measure.seconds, 1e-6), 2),
+        "peak_rss_mib": round(measure.peak_rss / (1 << 20), 1),
+        "written_bytes": measure.written,
+    }
+    entry.update(extra)
+    return entry
+
+
+def reset_peak_rss():
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def tree_size(path: Path) -> int:
+    return sum(
+        os.lstat(os.path.join(dir_path, name)).st_size
+        for dir_path, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def is_tmpfs(path: Path) -> bool:
+    path = str(path.resolve())
+    for part in sorted(
+        disk_partitions(all=True), key=lambda p: len(p.mountpoint), reverse=True
+    ):
+        if path.startswith(part.mountpoint):
+            return part.fstype == "tmpfs"
+    return False
+
+
+def result_key(entry: dict) -> tuple:
+    return (
+        entry["bench"],
+        entry["shape"],
+        entry.get("level"),
+        entry.get("threads"),
+    )
+
+
+def print_results(results: list):
+    for entry in results:
+        name = " ".join(str(part) for part in result_key(entry) if part is not None)
+        line = (
+            f"{name:<24} {entry['seconds']:>9.3f}s {entry['throughput_mib_s']:>9.1f} "
+            f"MiB/s {entry['peak_rss_mib']:>7.1f} MiB RSS "
+            f"{entry['written_bytes'] >> 20:>6} MiB written"
+        )
+        if entry.get("ratio"):
+            line += f" ratio {entry['ratio']}"
+        print(line)
+
+
+def compare(baseline: dict, report: dict):
+    previous = {result_key(entry): entry for entry in baseline["results"]}
+    print(f"\nCompared with {baseline['version']} ({baseline['created']}):")
+    if baseline["scale"] != report["scale"]:
+        print(f"Warning: scale differs ({baseline['scale']} != {report['scale']})")
+    for entry in report["results"]:
+        old = previous.get(result_key(entry))
+        if old is None or not old["throughput_mib_s"]:
+            continue
+        name = " ".join(str(part) for part in result_key(entry) if part is not None)
+        change = entry["throughput_mib_s"] / old["throughput_mib_s"] * 100 - 100
+        rss = entry["peak_rss_mib"] - old["peak_rss_mib"]
+        print(f"{name:<24} throughput {change:+7.1f}%  rss {rss:+7.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,654 @@
+import grp
+import hashlib
+import json
+import os
+import pwd
+import shutil
+import stat
+import struct
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import zstandard as zstd
+
+from .compression import STORE_MIN_SIZE, is_compressed
+from .dictionary import DICT_DIR_NAME, FRAME_HEADER_SIZE, get_decompressor
+from .filters import PathFilter
+from .scheduler import LIMITS
+
+FRAME_SIZE = 16 << 20
+BUFFER_SIZE = 4 << 20
+INDEX_MAGIC = b"RMFRIDX1"
+SKIPPABLE_MAGIC = 0x184D2A5E
+
+_INDEX_FOOTER = struct.Struct("<I8s")
+_SKIPPABLE_HEADER = struct.Struct("<II")
+_ENTRY_TYPES = {
+    tarfile.REGTYPE: "file",
+    tarfile.DIRTYPE: "dir",
+    tarfile.SYMTYPE: "symlink",
+}
+_TAR_HEADER = struct.Struct("100s8s8s8s12s12s8sc100s8s32s32s8s8s155s12x")
+
+
+class ArchiveWriter:
+    def __init__(
+        self,
+        f_out,
+        cctx: zstd.ZstdCompressor,
+        frame_size: int = FRAME_SIZE,
+        store_cctx: zstd.ZstdCompressor = None,
+        catalog: bool = False,
+    ):
+        self.f_out = _HashingWriter(f_out)
+        self.cctx = cctx
+        self.store_cctx = store_cctx
+        self.frame_size = frame_size
+        self.frames = []
+        self.dirs = []
+        self.entries = [] if catalog else None
+
+        self._compressor = None
+        self._frame = None
+        self._offset = 0
+        self._buffer = bytearray(BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._fill = 0
+
+    def add(self, path: Path, arcname: str, path_stat: os.stat_result = None) -> bool:
+        if path_stat is None:
+            path_stat = os.lstat(path)
+        mode = path_stat.st_mode
+        if stat.S_ISREG(mode):
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+            try:
+                self._add_file(fd, arcname, os.fstat(fd))
+            finally:
+                os.close(fd)
+            return False
+
+        if stat.S_ISDIR(mode):
+            typeflag = tarfile.DIRTYPE
+        elif stat.S_ISLNK(mode):
+            typeflag = tarfile.SYMTYPE
+        elif stat.S_ISFIFO(mode):
+            typeflag = tarfile.FIFOTYPE
+        elif stat.S_ISCHR(mode):
+            typeflag = tarfile.CHRTYPE
+        elif stat.S_ISBLK(mode):
+            typeflag = tarfile.BLKTYPE
+        else:
+            return False
+
+        linkname = os.readlink(path) if typeflag == tarfile.SYMTYPE else ""
+        self._start_member()
+        offset = self._offset - self._frame["raw_offset"]
+        self.write(_tar_header(arcname, path_stat, typeflag, 0, linkname))
+        self._frame["members"].append(arcname)
+        self._record(arcname, typeflag, path_stat, 0, None, offset)
+        if typeflag == tarfile.DIRTYPE:
+            self.dirs.append(arcname)
+            return True
+        return False
+
+    def add_bytes(self, arcname: str, data: bytes):
+        self._start_member()
+        info = tarfile.TarInfo(arcname)
+        info.size = len(data)
+        self.write(info.tobuf(tarfile.PAX_FORMAT))
+        self.write(data)
+        self._pad(len(data))
+        self._frame["members"].append(arcname)
+
+    def add_tree(self, root: Path, path_filter: PathFilter = None):
+        stack = [(root, ".", None)]
+        while stack:
+            path, arcname, path_stat = stack.pop()
+            try:
+                if self.add(path, arcname, path_stat):
+                    with os.scandir(path) as it:
+                        entries = sorted(it, key=lambda e: e.name, reverse=True)
+                    if path_filter is not None:
+                        entries = [
+                            entry
+                            for entry in entries
+                            if not path_filter.match(
+                                f"{arcname}/{entry.name}"[2:],
+                                entry.is_dir(follow_symlinks=False),
+                            )
+                        ]
+                    stack.extend(
+                        (
+                            Path(entry.path),
+                            f"{arcname}/{entry.name}",
+                            entry.stat(follow_symlinks=False),
+                        )
+                        for entry in entries
+                    )
+            except FileNotFoundError:
+                continue
+
+    def write(self, data) -> int:
+        if self._compressor is None:
+            self._open_frame()
+        size = len(data)
+        if self._fill + size > BUFFER_SIZE:
+            self._flush()
+        if size >= BUFFER_SIZE:
+            self._compress(data)
+        else:
+            self._view[self._fill : self._fill + size] = data
+            self._fill += size
+        self._offset += size
+        return size
+
+    def close(self) -> tuple[str, str]:
+        end = 2 * tarfile.BLOCKSIZE
+        self.write(bytes(end + -(self._offset + end) % tarfile.RECORDSIZE))
+        self._close_frame()
+
+        index = {"version": 1, "frames": self.frames, "dirs": self.dirs}
+        data = json.dumps(index).encode()
+        payload = data + _INDEX_FOOTER.pack(len(data), INDEX_MAGIC)
+        self.f_out.write(_SKIPPABLE_HEADER.pack(SKIPPABLE_MAGIC, len(payload)))
+        self.f_out.write(payload)
+        return self.f_out.hexdigest(), hashlib.sha256(data).hexdigest()
+
+    def _add_file(self, fd: int, arcname: str, path_stat: os.stat_result):
+        size = path_stat.st_size
+        store = (
+            self.store_cctx is not None
+            and size >= STORE_MIN_SIZE
+            and is_compressed(arcname)
+        )
+        if store:
+            self._close_frame()
+            self._open_frame(self.store_cctx)
+        else:
+            self._start_member()
+
+        offset = self._offset - self._frame["raw_offset"]
+        hasher = hashlib.sha256() if self.entries is not None else None
+        self.write(_tar_header(arcname, path_stat, tarfile.REGTYPE, size))
+        remaining = size
+        while remaining:
+            if self._fill == BUFFER_SIZE:
+                self._flush()
+            chunk = min(remaining, BUFFER_SIZE - self._fill)
+            read = os.readv(fd, [self._view[self._fill : self._fill + chunk]])
+            if not read:
+                break
+            if hasher is not None:
+                hasher.update(self._view[self._fill : self._fill + read])
+            self._fill += read
+            self._offset += read
+            remaining -= read
+        if remaining:
+            self.write(bytes(remaining))
+            if hasher is not None:
+                hasher.update(bytes(remaining))
+        self._pad(size)
+
+        self._frame["members"].append(arcname)
+        self._record(
+            arcname,
+            tarfile.REGTYPE,
+            path_stat,
+            size,
+            hasher.hexdigest() if hasher is not None else None,
+            offset,
+        )
+        if store:
+            self._close_frame()
+
+    def _record(
+        self,
+        arcname: str,
+        typeflag: bytes,
+        path_stat: os.stat_result,
+        size: int,
+        digest: str,
+        offset: int,
+    ):
+        if self.entries is None or arcname == ".":
+            return
+        self.entries.append(
+            (
+                arcname[2:] if arcname.startswith("./") else arcname,
+                _ENTRY_TYPES.get(typeflag, "special"),
+                size,
+                path_stat.st_mtime_ns,
+                digest,
+                len(self.frames),
+                offset,
+            )
+        )
+
+    def _pad(self, size: int):
+        padding = -size % tarfile.BLOCKSIZE
+        if padding:
+            self.write(bytes(padding))
+
+    def _flush(self):
+        if self._fill:
+            self._compress(self._view[: self._fill])
+            self._fill = 0
+
+    def _compress(self, data):
+        self._compressor.write(data)
+
+    def _start_member(self):
+        if self._frame is not None:
+            if self._offset - self._frame["raw_offset"] >= self.frame_size:
+                self._close_frame()
+        if self._compressor is None:
+            self._open_frame()
+
+    def _open_frame(self, cctx: zstd.ZstdCompressor = None):
+        self.f_out.frame_hasher = hashlib.sha256()
+        self._compressor = (cctx or self.cctx).stream_writer(self.f_out, closefd=False)
+        self._frame = {
+            "offset": self.f_out.tell(),
+            "raw_offset": self._offset,
+            "members": [],
+        }
+
+    def _close_frame(self):
+        if self._compressor is None:
+            return
+        self._flush()
+        self._compressor.close()
+        self._frame["size"] = self.f_out.tell() - self._frame["offset"]
+        self._frame["raw_size"] = self._offset - self._frame["raw_offset"]
+        self._frame["sha256"] = self.f_out.frame_hasher.hexdigest()
+        self.f_out.frame_hasher = None
+        self.frames.append(self._frame)
+        self._compressor = None
+        self._frame = None
+
+
+class _HashingWriter:
+    def __init__(self, f_out):
+        self.f_out = f_out
+        self.hasher = hashlib.sha256()
+        self.frame_hasher = None
+
+    def write(self, data) -> int:
+        LIMITS.throttle(len(data))
+        self.f_out.write(data)
+        self.hasher.update(data)
+        if self.frame_hasher is not None:
+            self.frame_hasher.update(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.f_out.tell()
+
+    def flush(self):
+        self.f_out.flush()
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+
+class _HashingReader:
+    def __init__(self, f_in, size: int):
+        self.f_in = f_in
+        self.remaining = size
+        self.hasher = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f_in.read(size)
+        self.remaining -= len(data)
+        self.hasher.update(data)
+        return data
+
+    def verify(self, expected_hash: str):
+        while self.read(1 << 20):
+            pass
+        if self.hasher.hexdigest() != expected_hash:
+            raise ValueError("Frame hash mismatch")
+
+
+def write_archive(
+    backup_file: Path,
+    cctx: zstd.ZstdCompressor,
+    add_members,
+    store_cctx: zstd.ZstdCompressor = None,
+    catalog: bool = False,
+) -> tuple[str, str, list]:
+    backup_temp_file = backup_file.with_suffix(backup_file.suffix + ".tmp")
+    try:
+        with open(backup_temp_file, "wb") as f_out:
+            writer = ArchiveWriter(f_out, cctx, store_cctx=store_cctx, catalog=catalog)
+            add_members(writer)
+            backup_hash, index_hash = writer.close()
+
+        os.replace(backup_temp_file, backup_file)
+        return backup_hash, index_hash, writer.entries
+
+    finally:
+        backup_temp_file.unlink(missing_ok=True)
+
+
+def read_index(backup_file: Path, index_hash: str = None) -> dict:
+    with open(backup_file, "rb") as f_in:
+        f_in.seek(0, os.SEEK_END)
+        if f_in.tell() < _INDEX_FOOTER.size:
+            return None
+
+        f_in.seek(-_INDEX_FOOTER.size, os.SEEK_END)
+        index_size, magic = _INDEX_FOOTER.unpack(f_in.read(_INDEX_FOOTER.size))
+        if magic != INDEX_MAGIC:
+            return None
+
+        f_in.seek(-(_INDEX_FOOTER.size + index_size), os.SEEK_END)
+        data = f_in.read(index_size)
+        if index_hash is not None and hashlib.sha256(data).hexdigest() != index_hash:
+            raise ValueError("Index hash mismatch")
+        return json.loads(data)
+
+
+def extract_archive(backup_file: Path, dest: Path, workers: int, skip: str = None):
+    index = read_index(backup_file)
+    if index is None:
+        return _extract_stream(backup_file, dest, skip)
+
+    make_dirs(index, dest)
+    return extract_frames(backup_file, index["frames"], dest, workers, skip)
+
+
+def make_dirs(index: dict, dest: Path):
+    for arcname in index["dirs"]:
+        _clear(dest / arcname, True)
+        (dest / arcname).mkdir(parents=True, exist_ok=True)
+
+
+def split_frames(index: dict, match) -> tuple[list, list]:
+    hot = []
+    cold = []
+    for frame in index["frames"]:
+        if any(match(arcname) for arcname in frame["members"]):
+            hot.append(frame)
+        else:
+            cold.append(frame)
+    return hot, cold
+
+
+def extract_frames(
+    backup_file: Path,
+    frames: list,
+    dest: Path,
+    workers: int,
+    skip: str = None,
+    keep_existing: bool = False,
+):
+    skipped = None
+    directories = []
+    with ThreadPoolExecutor(max_workers=workers or None) as pool:
+        futures = [
+            pool.submit(_extract_frame, backup_file, frame, dest, skip, keep_existing)
+            for frame in frames
+        ]
+        for future in futures:
+            frame_dirs, frame_skipped = future.result()
+            directories.extend(frame_dirs)
+            skipped = frame_skipped or skipped
+
+    for member in sorted(directories, key=lambda m: m.name, reverse=True):
+        path = dest / member.name
+        os.chmod(path, member.mode)
+        os.utime(path, (member.mtime, member.mtime))
+
+    return skipped
+
+
+def _extract_frame(
+    backup_file: Path, frame: dict, dest: Path, skip: str, keep_existing: bool
+):
+    directories = []
+    skipped = None
+    with open(backup_file, "rb") as f_in:
+        f_in.seek(frame["offset"])
+        dctx = get_decompressor(
+            backup_file.parent / DICT_DIR_NAME,
+            f_in.read(min(frame["size"], FRAME_HEADER_SIZE)),
+        )
+        f_in.seek(frame["offset"])
+        reader = _HashingReader(f_in, frame["size"])
+        with dctx.stream_reader(reader, closefd=False) as decompressor:
+            with tarfile.open(fileobj=decompressor, mode="r|") as tar:
+                for member in tar:
+                    if member.name == skip:
+                        skipped = tar.extractfile(member).read()
+                    elif member.isdir():
+                        directories.append(member)
+                    elif keep_existing and os.path.lexists(dest / member.name):
+                        continue
+                    else:
+                        _clear(dest / member.name, False)
+                        tar.extract(member, dest)
+                        if member.issym():
+                            os.utime(
+                                dest / member.name,
+                                (member.mtime, member.mtime),
+                                follow_symlinks=False,
+                            )
+            while decompressor.read(1 << 20):
+                pass
+
+        if "sha256" in frame:
+            reader.verify(frame["sha256"])
+    return directories, skipped
+
+
+def extract_members(
+    backup_file: Path, frame: dict, offset: int, names: set, dest: Path
+) -> list:
+    extracted = []
+    with open(backup_file, "rb") as f_in:
+        f_in.seek(frame["offset"])
+        dctx = get_decompressor(
+            backup_file.parent / DICT_DIR_NAME,
+            f_in.read(min(frame["size"], FRAME_HEADER_SIZE)),
+        )
+        f_in.seek(frame["offset"])
+        reader = _HashingReader(f_in, frame["size"])
+        with dctx.stream_reader(reader, closefd=False) as decompressor:
+            decompressor.seek(offset)
+            with tarfile.open(fileobj=decompressor, mode="r|") as tar:
+                for member in tar:
+                    if member.name not in names:
+                        continue
+                    _clear(dest / member.name, member.isdir())
+                    tar.extract(member, dest)
+                    extracted.append(member)
+                    if len(extracted) == len(names):
+                        break
+    return extracted
+
+
+def _extract_stream(backup_file: Path, dest: Path, skip: str):
+    skipped = None
+    dctx = zstd.ZstdDecompressor()
+
+    with open(backup_file, "rb") as f_in:
+        with dctx.stream_reader(f_in, read_across_frames=True) as decompressor:
+            with tarfile.open(fileobj=decompressor, mode="r|") as tar:
+
+                def members():
+                    nonlocal skipped
+                    for member in tar:
+                        if member.name == skip:
+                            skipped = tar.extractfile(member).read()
+                        else:
+                            yield member
+
+                tar.extractall(dest, members=members())
+    return skipped
+
+
+def _clear(path: Path, is_dir: bool):
+    try:
+        path_stat = os.lstat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    if stat.S_ISDIR(path_stat.st_mode):
+        if not is_dir:
+            shutil.rmtree(path)
+    elif is_dir or stat.S_ISLNK(path_stat.st_mode):
+        path.unlink()
+
+
+def _tar_header(
+    arcname: str,
+    path_stat: os.stat_result,
+    typeflag: bytes,
+    size: int,
+    linkname: str = "",
+) -> bytes:
+    mtime = int(path_stat.st_mtime)
+    uname = _user_name(path_stat.st_uid)
+    gname = _group_name(path_stat.st_gid)
+    if not (
+        len(arcname) <= tarfile.LENGTH_NAME
+        and len(linkname) <= tarfile.LENGTH_LINK
+        and arcname.isascii()
+        and linkname.isascii()
+        and len(uname) <= 32
+        and len(gname) <= 32
+        and size < 8**11
+        and 0 <= mtime < 8**11
+        and path_stat.st_uid < 8**7
+        and path_stat.st_gid < 8**7
+    ):
+        return _pax_header(arcname, path_stat, typeflag, size, linkname, uname, gname)
+
+    if typeflag in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        device = (os.major(path_stat.st_rdev), os.minor(path_stat.st_rdev))
+    else:
+        device = (0, 0)
+    header = _ustar_header(
+        arcname.encode(),
+        stat.S_IMODE(path_stat.st_mode),
+        path_stat.st_uid,
+        path_stat.st_gid,
+        size,
+        mtime,
+        typeflag,
+        linkname.encode(),
+        uname,
+        gname,
+        device,
+    )
+
+    seconds, nanoseconds = divmod(path_stat.st_mtime_ns, 1_000_000_000)
+    if not nanoseconds:
+        return header
+    record = _pax_record("mtime", f"{seconds}.{nanoseconds:09d}".rstrip("0"))
+    return (
+        _ustar_header(
+            b"././@PaxHeader",
+            0o644,
+            0,
+            0,
+            len(record),
+            0,
+            tarfile.XHDTYPE,
+            b"",
+            b"",
+            b"",
+            (0, 0),
+        )
+        + record
+        + bytes(-len(record) % tarfile.BLOCKSIZE)
+        + header
+    )
+
+
+def _ustar_header(
+    name: bytes,
+    mode: int,
+    uid: int,
+    gid: int,
+    size: int,
+    mtime: int,
+    typeflag: bytes,
+    linkname: bytes,
+    uname: bytes,
+    gname: bytes,
+    device: tuple[int, int],
+) -> bytes:
+    header = bytearray(
+        _TAR_HEADER.pack(
+            name,
+            b"%07o" % mode,
+            b"%07o" % uid,
+            b"%07o" % gid,
+            b"%011o" % size,
+            b"%011o" % mtime,
+            b" " * 8,
+            typeflag,
+            linkname,
+            tarfile.POSIX_MAGIC,
+            uname,
+            gname,
+            b"%07o" % device[0],
+            b"%07o" % device[1],
+            b"",
+        )
+    )
+    header[148:156] = b"%06o\0 " % sum(header)
+    return bytes(header)
+
+
+def _pax_record(keyword: str, value: str) -> bytes:
+    length = len(keyword) + len(value) + 3
+    size = length + len(str(length))
+    size = length + len(str(size))
+    return f"{size} {keyword}={value}\n".encode()
+
+
+def _pax_header(
+    arcname: str,
+    path_stat: os.stat_result,
+    typeflag: bytes,
+    size: int,
+    linkname: str,
+    uname: bytes,
+    gname: bytes,
+) -> bytes:
+    info = tarfile.TarInfo(arcname)
+    info.type = typeflag
+    info.mode = stat.S_IMODE(path_stat.st_mode)
+    info.uid = path_stat.st_uid
+    info.gid = path_stat.st_gid
+    info.size = size
+    info.mtime = path_stat.st_mtime
+    info.linkname = linkname
+    info.uname = uname.decode(errors="surrogateescape")
+    info.gname = gname.decode(errors="surrogateescape")
+    if typeflag in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        info.devmajor = os.major(path_stat.st_rdev)
+        info.devminor = os.minor(path_stat.st_rdev)
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+@lru_cache(maxsize=None)
+def _user_name(uid: int) -> bytes:
+    try:
+        return pwd.getpwuid(uid).pw_name.encode()
+    except KeyError:
+        return b""
+
+
+@lru_cache(maxsize=None)
+def _group_name(gid: int) -> bytes:
+    try:
+        return grp.getgrgid(gid).gr_name.encode()
+    except KeyError:
+        return b""
@@ -1,92 +1,464 @@
-import os
+import json
 import shutil
 import tarfile
+from fnmatch import fnmatch
 from pathlib import Path
+from threading import Thread
+from time import monotonic, process_time
 
 import zstandard as zstd
 
+from .archive import (
+    ArchiveWriter,
+    extract_archive,
+    extract_frames,
+    make_dirs,
+    read_index,
+    split_frames,
+    write_archive,
+)
+from .catalog import catalog_exists, get_catalog, manifest_entries
+from .changes import get_detector
+from .chunks import get_chunk_store, release_snapshot, restore_snapshot, write_snapshot
+from .compression import (
+    choose_level,
+    compressor,
+    record_compression,
+    store_compressor,
+)
+from .dictionary import get_dictionary, prune_dictionaries
 from .log import log_info, log_warning
-from .state import get_backups, get_hash_history, mark_backup, mark_hash, remove_backup
+from .metrics import METRICS
+from .scheduler import LIMITS
+from .snapshot import get_snapshot
+from .state import (
+    get_backup_chain,
+    get_backups,
+    get_hash_history,
+    get_hot_files,
+    mark_backup,
+    mark_hash,
+    mark_hot_files,
+    remove_backup,
+)
 from .target import Target
-from .utils import current_timestamp, ensure_dir, get_file_hash, get_tree_state_hash
+from .utils import current_timestamp, ensure_dir, get_file_hash
+from .workers import WORKERS
+
+MANIFEST_NAME = ".ramifier-manifest.json"
+HOT_FILES_LIMIT = 1000
+
+_CHAIN_HEADS = {}
 
 
 def backup_target(target: Target, force: bool = False):
-    current_hash = get_tree_state_hash(target.path)
+    detector = get_detector(target)
+    current_hash, dirty = detector.snapshot()
 
-    if not force and not _has_changes(target, current_hash):
+    if not force and not dirty and not _has_changes(target, current_hash):
         log_info("Nothing to backup", target.name)
         mark_hash(target, current_hash)
         return
 
-    backup_file = target.backup_path / f"{target.name}-{current_timestamp()}.tar.zst"
-    backup_hash = _compress_target(target, backup_file)
-    mark_backup(target, backup_file, backup_hash)
+    files = detector.files()
+    dirs = detector.dirs()
+    with detector.ignore_access():
+        if target.snapshot:
+            root = get_snapshot(target).stage(dirty, files, dirs)
+        else:
+            root = target.data_path.resolve()
+        with LIMITS.compression(target.priority):
+            backup_file = _write_backup(target, dirty, files, dirs, root)
+
+    _CHAIN_HEADS[target.name] = str(backup_file)
     mark_hash(target, current_hash)
+    mark_hot_files(target, detector.hot_files(HOT_FILES_LIMIT))
+    detector.clear_dirty(dirty)
     _cleanup_old_backups(target)
 
 
-def restore_target(target: Target):
+def restore_target(target: Target, lazy: bool = True, root: Path = None) -> Thread:
     backups = get_backups(target)
     for backup in reversed(backups):
-        file = backup.get("file")
-        expected_hash = backup.get("hash")
-
-        if not file or not expected_hash:
+        chain = get_backup_chain(target, backup)
+        if not chain:
+            log_warning(
+                f"Skipping backup (broken chain): {backup.get('file')}", target.name
+            )
             continue
 
-        backup_file = Path(file)
-        if not backup_file.exists():
-            log_warning(f"Backup file not found: {backup_file}", target.name)
+        if not all(_is_valid_backup(target, b) for b in chain):
             continue
 
-        if expected_hash == get_file_hash(backup_file):
-            _decompress_target(target, backup_file)
-            return
-        else:
-            log_warning(f"Skipping backup (hash mismatch): {backup_file}", target.name)
+        try:
+            with METRICS.timer("restore", target.name):
+                return _restore_chain(target, chain, lazy, root or target.data_path)
+        except (ValueError, tarfile.TarError, zstd.ZstdError) as e:
+            log_warning(
+                f"Skipping backup (verification failed): {backup.get('file')}: {e}",
+                target.name,
+            )
 
     raise FileNotFoundError(f"No valid backup found")
 
 
+def _restore_chain(target: Target, chain: list, lazy: bool, root: Path) -> Thread:
+    backup_file = Path(chain[0]["file"])
+    if chain[0].get("kind") == "chunks":
+        _restore_chunks(target, backup_file, root)
+        return None
+
+    index = read_index(backup_file)
+    if (
+        lazy
+        and target.lazy_restore
+        and root == target.data_path
+        and len(chain) == 1
+        and index is not None
+    ):
+        return _lazy_restore(target, backup_file, index)
+
+    WORKERS.run(
+        target.priority, _extract_chain, target, [b["file"] for b in chain], root
+    )
+    return None
+
+
+def _extract_chain(target: Target, files: list, root: Path):
+    _decompress_target(target, Path(files[0]), root)
+    for file in files[1:]:
+        _apply_changes(target, Path(file), root)
+
+
+def _write_backup(
+    target: Target, dirty: dict, files: dict, dirs: set, root: Path
+) -> Path:
+    timestamp = current_timestamp()
+    parent = _incremental_parent(target)
+    if target.backend == "chunks":
+        parent = None
+    changed = sorted(rel for rel in dirty if rel in files or rel in dirs)
+    deleted = _deleted_roots(
+        [rel for rel in dirty if rel not in files and rel not in dirs], files, dirs
+    )
+
+    raw_size = sum(
+        files[rel][0] for rel in (files if parent is None else changed) if rel in files
+    )
+    level = choose_level(target, raw_size)
+    dictionary = get_dictionary(target, files, parent is None)
+    dict_id = dictionary.dict_id() if dictionary is not None else None
+    dict_data = dictionary.as_bytes() if dictionary is not None else None
+    started = monotonic()
+
+    if target.backend == "chunks":
+        backup_file = target.backup_path / f"{target.name}-{timestamp}.manifest.zst"
+        cpu_started = process_time()
+        backup_hash, entries = _store_chunks(
+            target, backup_file, level, dict_data, root
+        )
+        cpu_seconds = process_time() - cpu_started
+        mark_backup(target, backup_file, backup_hash, "chunks", dict_id=dict_id)
+        _catalog_backup(
+            target,
+            backup_file,
+            "chunks",
+            None,
+            manifest_entries(entries),
+            target.chunk_store.resolve(),
+        )
+    elif parent is None:
+        backup_file = target.backup_path / f"{target.name}-{timestamp}.tar.zst"
+        (backup_hash, index_hash, entries), cpu_seconds = WORKERS.run(
+            target.priority,
+            _compress_target,
+            target,
+            backup_file,
+            level,
+            dict_data,
+            root,
+        )
+        mark_backup(
+            target, backup_file, backup_hash, index_hash=index_hash, dict_id=dict_id
+        )
+        _catalog_backup(target, backup_file, "full", None, entries)
+    else:
+        backup_file = target.backup_path / f"{target.name}-{timestamp}.tar.zst"
+        (backup_hash, index_hash, entries), cpu_seconds = WORKERS.run(
+            target.priority,
+            _compress_changes,
+            target,
+            backup_file,
+            level,
+            dict_data,
+            root,
+            parent,
+            changed,
+            deleted,
+        )
+        mark_backup(
+            target,
+            backup_file,
+            backup_hash,
+            "incremental",
+            parent,
+            index_hash,
+            dict_id,
+        )
+        _catalog_backup(target, backup_file, "incremental", parent, entries)
+
+    seconds = monotonic() - started
+    output_size = backup_file.stat().st_size
+    record_compression(target, level, raw_size, output_size, seconds, cpu_seconds)
+    METRICS.observe("compression", seconds, target.name)
+    METRICS.inc("backups", target.name)
+    METRICS.inc("backup_raw_bytes", target.name, raw_size)
+    METRICS.inc("backup_written_bytes", target.name, output_size)
+    if target.compression_level == "auto":
+        log_info(f"Compressed at level {level} in {seconds:.1f}s", target.name)
+
+    return backup_file
+
+
+def _catalog_backup(
+    target: Target,
+    backup_file: Path,
+    kind: str,
+    parent: str,
+    entries: list,
+    store: Path = None,
+):
+    if not target.catalog or entries is None:
+        return
+    started = monotonic()
+    get_catalog(target.name).add_backup(backup_file, kind, parent, entries, store)
+    METRICS.observe("catalog", monotonic() - started, target.name)
+
+
 def _has_changes(target: Target, current_hash: str) -> bool:
     last_hash = (get_hash_history(target) or [None])[-1]
     return current_hash != last_hash
 
 
-def _compress_target(target: Target, backup_file: Path) -> str:
-    cctx = zstd.ZstdCompressor(
-        level=target.compression_level, threads=target.compression_threads
-    )
+def _is_valid_backup(target: Target, backup: dict) -> bool:
+    file = backup.get("file")
+    expected_hash = backup.get("hash")
+
+    if not file or not expected_hash:
+        return False
+
+    backup_file = Path(file)
+    if not backup_file.exists():
+        log_warning(f"Backup file not found: {backup_file}", target.name)
+        return False
 
-    backup_temp_file = backup_file.with_suffix(backup_file.suffix + ".tmp")
     try:
-        with open(backup_temp_file, "wb") as f_out:
-            with cctx.stream_writer(f_out) as compressor:
-                with tarfile.open(fileobj=compressor, mode="w|") as tar:
-                    tar.add(target.path.resolve(), arcname=".")
+        if backup.get("index_hash"):
+            read_index(backup_file, backup["index_hash"])
+        elif expected_hash != get_file_hash(backup_file):
+            raise ValueError("Backup hash mismatch")
+    except ValueError:
+        log_warning(f"Skipping backup (hash mismatch): {backup_file}", target.name)
+        return False
+
+    return True
+
+
+def _incremental_parent(target: Target) -> str:
+    if target.full_backup_every <= 1:
+        return None
+
+    backups = get_backups(target)
+    if not backups or backups[-1].get("file") != _CHAIN_HEADS.get(target.name):
+        return None
+
+    chain = get_backup_chain(target, backups[-1])
+    if not chain or len(chain) >= target.full_backup_every:
+        return None
+
+    return backups[-1]["file"]
+
+
+def _compress_target(
+    target: Target, backup_file: Path, level: int, dict_data: bytes, root: Path
+) -> tuple[str, str, list]:
+    result = write_archive(
+        backup_file,
+        _compressor(target, level, dict_data),
+        lambda writer: writer.add_tree(root, target.path_filter),
+        store_compressor(),
+        target.catalog,
+    )
+    log_info(f"Backed up at {backup_file}", target.name)
+    return result
+
+
+def _compress_changes(
+    target: Target,
+    backup_file: Path,
+    level: int,
+    dict_data: bytes,
+    root: Path,
+    parent: str,
+    changed: list,
+    deleted: list,
+) -> tuple[str, str, list]:
+    def add_changes(writer: ArchiveWriter):
+        manifest = {
+            "kind": "incremental",
+            "parent": Path(parent).name,
+            "changed": changed,
+            "deleted": deleted,
+        }
+        writer.add_bytes(MANIFEST_NAME, json.dumps(manifest).encode())
+
+        for rel in changed:
+            try:
+                writer.add(root / rel, f"./{rel}")
+            except FileNotFoundError:
+                continue
+
+    backup_hash, index_hash, entries = write_archive(
+        backup_file,
+        _compressor(target, level, dict_data),
+        add_changes,
+        store_compressor(),
+        target.catalog,
+    )
+    if entries is not None:
+        entries += [(rel, "deleted", 0, None, None, None, None) for rel in deleted]
+    log_info(f"Backed up at {backup_file}", target.name)
+    log_info(
+        f"Incremental backup: {len(changed)} changed, {len(deleted)} deleted",
+        target.name,
+    )
+    return backup_hash, index_hash, entries
+
+
+def _store_chunks(
+    target: Target, backup_file: Path, level: int, dict_data: bytes, root: Path
+) -> tuple[str, list]:
+    store = get_chunk_store(target.chunk_store)
+    result = write_snapshot(
+        store,
+        root,
+        backup_file,
+        _compressor(target, level, dict_data),
+        store_compressor(),
+        target.path_filter,
+    )
+    log_info(f"Backed up at {backup_file}", target.name)
+    return result
+
+
+def _compressor(target: Target, level: int, dict_data: bytes) -> zstd.ZstdCompressor:
+    dictionary = zstd.ZstdCompressionDict(dict_data) if dict_data else None
+    return compressor(target, level, dictionary)
+
+
+def _restore_chunks(target: Target, backup_file: Path, root: Path):
+    if root.exists():
+        shutil.rmtree(root)
+    ensure_dir(root)
+
+    store = get_chunk_store(target.chunk_store)
+    restore_snapshot(store, backup_file, root)
+    log_info(f"Restored from {backup_file}", target.name)
+
+
+def _deleted_roots(deleted: list, files: dict, dirs: set) -> list:
+    roots = set()
+    for rel in deleted:
+        parent = rel.rpartition("/")[0]
+        while parent and parent not in dirs:
+            rel = parent
+            parent = rel.rpartition("/")[0]
+        if rel not in files:
+            roots.add(rel)
+    return sorted(roots)
 
-        backup_hash = get_file_hash(backup_temp_file)
-        os.replace(backup_temp_file, backup_file)
-        log_info(f"Backed up at {backup_file}", target.name)
-        return backup_hash
 
-    finally:
-        backup_temp_file.unlink(missing_ok=True)
+def _decompress_target(target: Target, backup_file: Path, root: Path):
+    if root.exists():
+        shutil.rmtree(root)
+    ensure_dir(root)
+
+    extract_archive(backup_file, root, target.restore_threads)
+    log_info(f"Restored from {backup_file}", target.name)
 
 
-def _decompress_target(target: Target, backup_file: Path):
+def _lazy_restore(target: Target, backup_file: Path, index: dict) -> Thread:
     if target.path.exists():
         shutil.rmtree(target.path)
     ensure_dir(target.path)
+    if target.ram_path.exists():
+        shutil.rmtree(target.ram_path)
+    ensure_dir(target.ram_path, 0o700)
 
-    dctx = zstd.ZstdDecompressor()
+    hot_files = {f"./{rel}" for rel in get_hot_files(target)}
+    hot, cold = split_frames(
+        index,
+        lambda arcname: arcname in hot_files
+        or any(fnmatch(arcname[2:], p) for p in target.restore_priority),
+    )
 
-    with open(backup_file, "rb") as f_in:
-        with dctx.stream_reader(f_in) as decompressor:
-            with tarfile.open(fileobj=decompressor, mode="r|") as tar:
-                tar.extractall(target.path)
-    log_info(f"Restored from {backup_file}", target.name)
+    make_dirs(index, target.ram_path)
+    extract_frames(backup_file, hot, target.ram_path, target.restore_threads)
+    log_info(
+        f"Restored priority files ({len(hot)}/{len(index['frames'])} frames) "
+        f"from {backup_file}",
+        target.name,
+    )
+
+    thread = _BackgroundRestore(target, backup_file, cold)
+    thread.start()
+    return thread
+
+
+class _BackgroundRestore(Thread):
+    def __init__(self, target: Target, backup_file: Path, frames: list):
+        super().__init__(daemon=True)
+        self.target = target
+        self.backup_file = backup_file
+        self.frames = frames
+        self.error = None
+
+    def run(self):
+        try:
+            extract_frames(
+                self.backup_file,
+                self.frames,
+                self.target.ram_path,
+                self.target.restore_threads,
+                keep_existing=True,
+            )
+            log_info(f"Restored from {self.backup_file}", self.target.name)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        self.join()
+        if self.error is not None:
+            raise RuntimeError("Background restore failed") from self.error
+
+
+def _apply_changes(target: Target, backup_file: Path, root: Path):
+    manifest = extract_archive(backup_file, root, target.restore_threads, MANIFEST_NAME)
+    if manifest is not None:
+        _delete_paths(root, json.loads(manifest).get("deleted", []))
+    log_info(f"Applied changes from {backup_file}", target.name)
+
+
+def _delete_paths(root: Path, deleted: list):
+    for rel in deleted:
+        path = root / rel
+        try:
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                path.unlink(missing_ok=True)
+        except NotADirectoryError:
+            continue
 
 
 def _cleanup_old_backups(target: Target):
@@ -94,15 +466,22 @@ def _cleanup_old_backups(target: Target):
     if not backups or len(backups) <= target.max_backups:
         return
 
+    required = set()
+    for backup in backups[-target.max_backups :]:
+        required.update(b.get("file") for b in get_backup_chain(target, backup))
+
     old_backups = backups[: -target.max_backups]
     for backup in old_backups:
         file = backup.get("file")
-        if not file:
+        if not file or file in required:
             continue
 
         backup_file = Path(file)
         try:
             if backup_file.exists():
+                if backup.get("kind") == "chunks":
+                    store = get_chunk_store(target.chunk_store)
+                    release_snapshot(store, backup_file)
                 backup_file.unlink()
                 log_info(f"Deleted old backup: {backup_file}", target.name)
 
@@ -111,3 +490,10 @@ def _cleanup_old_backups(target: Target):
 
         finally:
             remove_backup(target, backup)
+            if catalog_exists(target.name):
+                get_catalog(target.name).remove_backup(backup_file)
+
+    if target.backend == "chunks":
+        keep = get_chunk_store(target.chunk_store).dictionaries()
+        keep.update(b["dict_id"] for b in get_backups(target) if "dict_id" in b)
+        prune_dictionaries(target, keep)
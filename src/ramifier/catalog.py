@@ -0,0 +1,238 @@
+import os
+import sqlite3
+from collections import defaultdict
+from pathlib import Path
+from threading import Lock
+from time import time
+
+from .archive import extract_members, read_index
+from .chunks import get_chunk_store, restore_snapshot
+from .state import STATE_PATH
+from .utils import ensure_dir, get_file_hash
+
+CATALOG_PATH = STATE_PATH / "catalog"
+
+_ENTRY_FIELDS = ("path", "type", "size", "mtime", "hash", "frame", "offset")
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    file TEXT UNIQUE,
+    created REAL,
+    kind TEXT,
+    parent TEXT,
+    store TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    backup INTEGER,
+    path TEXT,
+    type TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    hash TEXT,
+    frame INTEGER,
+    offset INTEGER,
+    PRIMARY KEY (backup, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_path ON entries (path);
+"""
+
+_CATALOGS = {}
+_CATALOGS_LOCK = Lock()
+
+
+class Catalog:
+    def __init__(self, name: str):
+        self.name = name
+        self.file = CATALOG_PATH / f"{name}.sqlite"
+        self.lock = Lock()
+
+        ensure_dir(CATALOG_PATH)
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+
+    def add_backup(
+        self,
+        backup_file: Path,
+        kind: str,
+        parent: str,
+        entries: list,
+        store: Path = None,
+    ):
+        with self.lock, self._connect() as db:
+            self._delete(db, str(backup_file))
+            backup_id = db.execute(
+                "INSERT INTO backups (file, created, kind, parent, store) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (str(backup_file), time(), kind, parent, store and str(store)),
+            ).lastrowid
+            db.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((backup_id, *entry) for entry in entries),
+            )
+
+    def remove_backup(self, backup_file: Path):
+        with self.lock, self._connect() as db:
+            self._delete(db, str(backup_file))
+
+    def backups(self) -> list:
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT b.file, b.created, b.kind, b.parent, "
+                "COUNT(e.path), COALESCE(SUM(e.size), 0) "
+                "FROM backups b LEFT JOIN entries e "
+                "ON e.backup = b.id AND e.type != 'deleted' "
+                "GROUP BY b.id ORDER BY b.id"
+            ).fetchall()
+        return [
+            dict(zip(("file", "created", "kind", "parent", "entries", "size"), row))
+            for row in rows
+        ]
+
+    def find_backup(self, at: str = None) -> str:
+        for backup in reversed(self.backups()):
+            name = Path(backup["file"]).name
+            if at is None or at == backup["file"] or at in name:
+                return backup["file"]
+        raise FileNotFoundError(f"No backup matches {at or 'latest'}")
+
+    def history(self, path: str) -> list:
+        path = _normalize(path)
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT b.file, b.created, b.kind, "
+                + ", ".join(f"e.{field}" for field in _ENTRY_FIELDS)
+                + " FROM entries e JOIN backups b ON b.id = e.backup "
+                "WHERE e.path = ? OR (e.type = 'deleted' "
+                "AND substr(?, 1, length(e.path) + 1) = e.path || '/') "
+                "ORDER BY b.id",
+                (path, path),
+            ).fetchall()
+        return [
+            dict(zip(("file", "created", "kind") + _ENTRY_FIELDS, row)) for row in rows
+        ]
+
+    def resolve(self, backup_file: str, path: str) -> list:
+        path = _normalize(path)
+        prefix = f"{path}/" if path else ""
+        view = {}
+        with self._connect() as db:
+            for backup_id, file, store in self._chain(db, backup_file):
+                rows = db.execute(
+                    f"SELECT {', '.join(_ENTRY_FIELDS)} FROM entries "
+                    "WHERE backup = ? AND (path = ? OR substr(path, 1, ?) = ? "
+                    "OR (type = 'deleted' AND substr(?, 1, length(path) + 1) "
+                    "= path || '/')) ORDER BY type = 'deleted'",
+                    (backup_id, path, len(prefix), prefix, prefix),
+                )
+                for row in rows:
+                    entry = dict(zip(_ENTRY_FIELDS, row))
+                    if entry["type"] == "deleted":
+                        _forget(view, entry["path"])
+                    else:
+                        entry["backup"] = file
+                        entry["store"] = store
+                        view[entry["path"]] = entry
+        return sorted(view.values(), key=lambda entry: entry["path"])
+
+    def _chain(self, db: sqlite3.Connection, backup_file: str) -> list:
+        chain = []
+        while backup_file:
+            row = db.execute(
+                "SELECT id, file, store, parent FROM backups WHERE file = ?",
+                (backup_file,),
+            ).fetchone()
+            if row is None:
+                raise FileNotFoundError(f"Backup not in catalog: {backup_file}")
+            chain.append(row[:3])
+            backup_file = row[3]
+        chain.reverse()
+        return chain
+
+    def _delete(self, db: sqlite3.Connection, backup_file: str):
+        row = db.execute(
+            "SELECT id FROM backups WHERE file = ?", (backup_file,)
+        ).fetchone()
+        if row is not None:
+            db.execute("DELETE FROM entries WHERE backup = ?", row)
+            db.execute("DELETE FROM backups WHERE id = ?", row)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.file, timeout=60)
+
+
+def get_catalog(name: str) -> Catalog:
+    with _CATALOGS_LOCK:
+        catalog = _CATALOGS.get(name)
+        if catalog is None:
+            catalog = Catalog(name)
+            _CATALOGS[name] = catalog
+        return catalog
+
+
+def catalog_exists(name: str) -> bool:
+    return (CATALOG_PATH / f"{name}.sqlite").exists()
+
+
+def extract_entries(entries: list, dest: Path):
+    frames = defaultdict(dict)
+    chunked = defaultdict(set)
+    for entry in entries:
+        if entry["frame"] is None:
+            chunked[(entry["backup"], entry["store"])].add(entry["path"])
+        else:
+            frames[(entry["backup"], entry["frame"])][f"./{entry['path']}"] = entry
+
+    directories = []
+    for (file, frame), wanted in frames.items():
+        backup_file = Path(file)
+        index = read_index(backup_file)
+        offset = min(entry["offset"] for entry in wanted.values())
+        members = extract_members(
+            backup_file, index["frames"][frame], offset, set(wanted), dest
+        )
+        missing = set(wanted) - {member.name for member in members}
+        if missing:
+            raise ValueError(f"Missing from {backup_file.name}: {sorted(missing)[0]}")
+        directories.extend(member for member in members if member.isdir())
+
+    for (file, store), paths in chunked.items():
+        for rel in paths:
+            path = dest / rel
+            if os.path.lexists(path) and not path.is_dir():
+                path.unlink()
+        restore_snapshot(get_chunk_store(Path(store)), Path(file), dest, paths)
+
+    for member in sorted(directories, key=lambda m: m.name, reverse=True):
+        path = dest / member.name
+        os.chmod(path, member.mode)
+        os.utime(path, (member.mtime, member.mtime))
+
+    for entry in entries:
+        if entry["hash"] and get_file_hash(dest / entry["path"]) != entry["hash"]:
+            raise ValueError(f"Content hash mismatch: {entry['path']}")
+
+
+def manifest_entries(entries: list) -> list:
+    return [
+        (
+            entry["path"],
+            entry["type"],
+            entry.get("size", 0),
+            entry["mtime"],
+            None,
+            None,
+            None,
+        )
+        for entry in entries
+    ]
+
+
+def _forget(view: dict, path: str):
+    prefix = f"{path}/"
+    for rel in [rel for rel in view if rel == path or rel.startswith(prefix)]:
+        del view[rel]
+
+
+def _normalize(path: str) -> str:
+    path = os.path.normpath(path).strip("/")
+    return "" if path == "." else path
@@ -0,0 +1,555 @@
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import stat
+import struct
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+
+from .events import EVENT_LOOP
+from .filters import PathFilter
+from .log import log_warning
+from .metrics import METRICS
+from .target import Target
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+ACCESS_MASK = IN_OPEN | IN_CLOSE_NOWRITE
+
+_EVENT = struct.Struct("iIII")
+
+_DETECTORS = {}
+_DETECTORS_LOCK = Lock()
+
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._add_watch(
+            self.fd, os.fsencode(path), mask | IN_ONLYDIR | IN_DONT_FOLLOW
+        )
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self) -> list[tuple[int, int, str]]:
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ChangeDetector:
+    def __init__(
+        self,
+        path: Path,
+        name: str,
+        path_filter: PathFilter = None,
+        track_access: bool = False,
+    ):
+        self.path = path
+        self.name = name
+        self.path_filter = path_filter or PathFilter([], [])
+        self.mask = WATCH_MASK | ACCESS_MASK if track_access else WATCH_MASK
+        self.lock = Lock()
+
+        self._root = None
+        self._files = {}
+        self._dirs = {}
+        self._size = 0
+        self._dirty = {}
+        self._seq = 0
+        self._hash = None
+        self._access = Counter()
+        self._count_access = True
+
+        self._activity = [0, 0]
+        self._listeners = []
+
+        self._inotify = None
+        self._registered_fd = None
+        self._watches = {}
+        self._watched_dirs = {}
+
+    def refresh(self):
+        with self.lock, METRICS.timer("scan", self.name):
+            root = str(self.path.resolve())
+            root_stat = os.stat(root)
+            if self._root != (root_stat.st_dev, root_stat.st_ino):
+                self._rebuild(root, root_stat)
+            elif self._inotify is not None:
+                self._apply_events(root)
+            else:
+                self._scan(root, "")
+
+    def state_hash(self) -> str:
+        self.refresh()
+        with self.lock:
+            return self._state_hash()
+
+    def snapshot(self) -> tuple[str, dict]:
+        self.refresh()
+        with self.lock:
+            return self._state_hash(), dict(self._dirty)
+
+    def is_dirty(self) -> bool:
+        self.refresh()
+        with self.lock:
+            return bool(self._dirty)
+
+    def dirty_paths(self) -> dict:
+        self.refresh()
+        with self.lock:
+            return dict(self._dirty)
+
+    def dirty_size(self) -> tuple[int, int]:
+        self.refresh()
+        with self.lock:
+            size = sum(self._files[rel][0] for rel in self._dirty if rel in self._files)
+            return len(self._dirty), size
+
+    def total_size(self) -> int:
+        self.refresh()
+        return self.cached_size()
+
+    def cached_size(self) -> int:
+        with self.lock:
+            return self._size
+
+    def clear_dirty(self, dirty: dict):
+        with self.lock:
+            for rel, seq in dirty.items():
+                if self._dirty.get(rel) == seq:
+                    del self._dirty[rel]
+
+    def files(self) -> dict:
+        with self.lock:
+            return dict(self._files)
+
+    def dirs(self) -> set:
+        with self.lock:
+            return set(self._dirs)
+
+    def watching(self) -> bool:
+        with self.lock:
+            return self._inotify is not None
+
+    def add_listener(self, listener):
+        with self.lock:
+            self._listeners.append(listener)
+            self._register()
+
+    def remove_listener(self, listener):
+        with self.lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+            if not self._listeners:
+                self._unregister()
+
+    def access_counts(self) -> Counter:
+        self.refresh()
+        with self.lock:
+            return Counter(self._access)
+
+    def accesses(self) -> int:
+        with self.lock:
+            return sum(self._access.values())
+
+    def hot_files(self, limit: int) -> list[str]:
+        with self.lock:
+            return [rel for rel, _ in self._access.most_common(limit)]
+
+    @contextmanager
+    def ignore_access(self):
+        self.refresh()
+        self._count_access = False
+        try:
+            yield
+        finally:
+            try:
+                self.refresh()
+            finally:
+                self._count_access = True
+
+    def close(self):
+        with self.lock:
+            self._close_inotify()
+            self._root = None
+
+    def _on_events(self):
+        self.refresh()
+        with self.lock:
+            events, size = self._activity
+            self._activity = [0, 0]
+            listeners = list(self._listeners)
+
+        if events:
+            for listener in listeners:
+                listener(events, size)
+
+    def _state_hash(self) -> str:
+        if self._hash is None:
+            with METRICS.timer("hash", self.name):
+                sha256_hasher = hashlib.sha256()
+                for rel in sorted(self._files, key=lambda p: p.split("/")):
+                    sha256_hasher.update(os.fsencode(rel))
+                    sha256_hasher.update(
+                        str(self._files[rel][1] // 1_000_000_000).encode()
+                    )
+                for rel in sorted(self._dirs, key=lambda p: p.split("/")):
+                    if not rel:
+                        continue
+                    sha256_hasher.update(os.fsencode(f"{rel}/"))
+                    sha256_hasher.update(str(self._dirs[rel][3]).encode())
+                self._hash = sha256_hasher.hexdigest()
+        return self._hash
+
+    def _rebuild(self, root: str, root_stat: os.stat_result):
+        relocated = self._root is not None
+        old_files = self._files
+        old_dirs = self._dirs
+        dirty = self._dirty
+        activity = self._activity
+
+        self._close_inotify()
+        self._files = {}
+        self._dirs = {}
+        self._size = 0
+        self._dirty = {}
+        self._activity = [0, 0]
+        try:
+            self._inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            log_warning(f"inotify unavailable, using directory scans: {e}", self.name)
+
+        self._scan(root, "", force=True)
+        self._root = (root_stat.st_dev, root_stat.st_ino)
+        self._dirty = dirty
+        self._activity = activity
+        self._hash = None
+        self._register()
+
+        if not relocated:
+            return
+
+        for rel in old_files.keys() - self._files.keys():
+            self._mark_dirty(rel)
+        for rel, entry in self._files.items():
+            old_entry = old_files.get(rel)
+            if old_entry is None or _content(old_entry) != _content(entry):
+                self._mark_dirty(rel)
+        for rel in old_dirs.keys() ^ self._dirs.keys():
+            if rel:
+                self._mark_dirty(rel)
+        for rel, listing in self._dirs.items():
+            if rel and rel in old_dirs and old_dirs[rel][3] != listing[3]:
+                self._mark_dirty(rel)
+
+    def _scan(self, root: str, rel: str, force: bool = False):
+        stack = [rel]
+        while stack:
+            rel_dir = stack.pop()
+            abs_dir = _join(root, rel_dir)
+            try:
+                dir_stat = os.stat(abs_dir)
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                self._drop_dir(rel_dir)
+                continue
+
+            cached = self._dirs.get(rel_dir)
+            if force or cached is None or cached[0] != dir_stat.st_mtime_ns:
+                cached = self._list_dir(root, rel_dir, dir_stat, cached)
+            elif cached[3] != dir_stat.st_mode:
+                self._update_dir(rel_dir, cached, dir_stat.st_mode)
+
+            for name in list(cached[1]):
+                self._stat_file(root, _join(rel_dir, name))
+            for name in cached[2]:
+                stack.append(_join(rel_dir, name))
+
+    def _list_dir(
+        self, root: str, rel_dir: str, dir_stat: os.stat_result, cached: list
+    ) -> list:
+        if self._inotify is not None and rel_dir not in self._watched_dirs:
+            self._watch(root, rel_dir)
+
+        files = set()
+        subdirs = set()
+        try:
+            with os.scandir(_join(root, rel_dir)) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if self.path_filter.match(_join(rel_dir, entry.name), is_dir):
+                            continue
+                        if is_dir:
+                            subdirs.add(entry.name)
+                        else:
+                            files.add(entry.name)
+                    except OSError:
+                        continue
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            pass
+
+        if cached is not None:
+            for name in cached[1] - files:
+                self._drop_file(_join(rel_dir, name))
+            for name in cached[2] - subdirs:
+                self._drop_dir(_join(rel_dir, name))
+            if cached[3] != dir_stat.st_mode:
+                self._update_dir(rel_dir, cached, dir_stat.st_mode)
+        elif rel_dir:
+            self._mark_dirty(rel_dir)
+
+        listing = [dir_stat.st_mtime_ns, files, subdirs, dir_stat.st_mode]
+        self._dirs[rel_dir] = listing
+        return listing
+
+    def _update_dir(self, rel_dir: str, listing: list, mode: int):
+        listing[3] = mode
+        if rel_dir:
+            self._activity[0] += 1
+            self._mark_dirty(rel_dir)
+
+    def _watch(self, root: str, rel_dir: str):
+        try:
+            wd = self._inotify.add_watch(_join(root, rel_dir), self.mask)
+        except OSError as e:
+            log_warning(f"inotify watch failed, using directory scans: {e}", self.name)
+            self._close_inotify()
+            return
+        self._watches[wd] = rel_dir
+        self._watched_dirs[rel_dir] = wd
+
+    def _apply_events(self, root: str):
+        pending = set()
+        for wd, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self._close_inotify()
+                self._inotify = Inotify()
+                self._scan(root, "", force=True)
+                self._register()
+                return
+
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None:
+                continue
+
+            if mask & IN_IGNORED:
+                self._unwatch(rel_dir, wd)
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if rel_dir == "":
+                    self._root = ()
+                continue
+
+            rel = _join(rel_dir, name)
+            if self.path_filter.match(rel, bool(mask & IN_ISDIR)):
+                continue
+            if mask & IN_CLOSE_NOWRITE:
+                continue
+            elif mask & IN_OPEN:
+                if self._count_access and not mask & IN_ISDIR:
+                    self._access[rel] += 1
+            elif mask & IN_ISDIR:
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._drop_dir(rel)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    if rel_dir in self._dirs:
+                        self._dirs[rel_dir][2].add(name)
+                    self._scan(root, rel, force=True)
+                elif mask & IN_ATTRIB:
+                    self._stat_dir(root, rel)
+            else:
+                pending.add(rel)
+
+        for rel in pending:
+            self._stat_file(root, rel)
+
+    def _stat_dir(self, root: str, rel: str):
+        listing = self._dirs.get(rel)
+        try:
+            dir_stat = os.lstat(_join(root, rel))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return
+        if listing is not None and stat.S_ISDIR(dir_stat.st_mode):
+            if listing[3] != dir_stat.st_mode:
+                self._update_dir(rel, listing, dir_stat.st_mode)
+
+    def _stat_file(self, root: str, rel: str):
+        try:
+            file_stat = os.lstat(_join(root, rel))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            self._drop_file(rel)
+            return
+
+        if stat.S_ISDIR(file_stat.st_mode) or stat.S_ISSOCK(file_stat.st_mode):
+            self._drop_file(rel)
+            return
+
+        entry = (
+            file_stat.st_size,
+            file_stat.st_mtime_ns,
+            file_stat.st_ino,
+            file_stat.st_mode,
+        )
+        old_entry = self._files.get(rel)
+        if old_entry != entry:
+            self._activity[0] += 1
+            self._activity[1] += file_stat.st_size
+            self._size += entry[0] - (old_entry[0] if old_entry else 0)
+            self._files[rel] = entry
+            parent, _, name = rel.rpartition("/")
+            if parent in self._dirs:
+                self._dirs[parent][1].add(name)
+            self._mark_dirty(rel)
+
+    def _drop_file(self, rel: str):
+        parent, _, name = rel.rpartition("/")
+        if parent in self._dirs:
+            self._dirs[parent][1].discard(name)
+        entry = self._files.pop(rel, None)
+        if entry is not None:
+            self._size -= entry[0]
+            self._activity[0] += 1
+            self._mark_dirty(rel)
+
+    def _drop_dir(self, rel: str):
+        parent, _, name = rel.rpartition("/")
+        if rel and parent in self._dirs:
+            self._dirs[parent][2].discard(name)
+
+        stack = [rel]
+        while stack:
+            rel_dir = stack.pop()
+            listing = self._dirs.pop(rel_dir, None)
+            wd = self._watched_dirs.get(rel_dir)
+            if wd is not None:
+                self._unwatch(rel_dir, wd)
+                self._inotify.rm_watch(wd)
+            if listing is None:
+                continue
+            if rel_dir:
+                self._activity[0] += 1
+                self._mark_dirty(rel_dir)
+            for name in listing[1]:
+                entry = self._files.pop(_join(rel_dir, name), None)
+                if entry is not None:
+                    self._size -= entry[0]
+                    self._mark_dirty(_join(rel_dir, name))
+            stack.extend(_join(rel_dir, name) for name in listing[2])
+
+    def _unwatch(self, rel_dir: str, wd: int):
+        self._watches.pop(wd, None)
+        if self._watched_dirs.get(rel_dir) == wd:
+            del self._watched_dirs[rel_dir]
+
+    def _mark_dirty(self, rel: str):
+        self._seq += 1
+        self._dirty[rel] = self._seq
+        self._hash = None
+
+    def _register(self):
+        if self._inotify is None or not self._listeners:
+            return
+        if self._registered_fd != self._inotify.fd:
+            self._unregister()
+            EVENT_LOOP.register(self._inotify.fd, self._on_events)
+            self._registered_fd = self._inotify.fd
+
+    def _unregister(self):
+        if self._registered_fd is not None:
+            EVENT_LOOP.unregister(self._registered_fd)
+            self._registered_fd = None
+
+    def _close_inotify(self):
+        self._unregister()
+        if self._inotify is not None:
+            self._inotify.close()
+        self._inotify = None
+        self._watches = {}
+        self._watched_dirs = {}
+
+
+def get_detector(target: Target) -> ChangeDetector:
+    with _DETECTORS_LOCK:
+        detector = _DETECTORS.get(target.name)
+        if detector is None:
+            detector = ChangeDetector(
+                target.data_path,
+                target.name,
+                target.path_filter,
+                target.tiered or target.lazy_restore,
+            )
+            _DETECTORS[target.name] = detector
+        return detector
+
+
+def drop_detector(target: Target):
+    with _DETECTORS_LOCK:
+        detector = _DETECTORS.pop(target.name, None)
+    if detector is not None:
+        detector.close()
+
+
+def _content(entry: tuple) -> tuple:
+    return entry[0], entry[1], entry[3]
+
+
+def _join(parent: str, name: str) -> str:
+    return f"{parent}/{name}" if parent else name
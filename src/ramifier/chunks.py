@@ -0,0 +1,299 @@
+import hashlib
+import json
+import os
+import sqlite3
+import stat
+from collections import Counter
+from pathlib import Path
+from threading import Lock
+
+import zstandard as zstd
+
+from .compression import is_compressed
+from .dictionary import DICT_DIR_NAME, FRAME_HEADER_SIZE, get_decompressor
+from .filters import PathFilter
+from .scheduler import LIMITS
+from .utils import ensure_dir
+
+CHUNK_SIZE = 1 << 20
+
+_STORES = {}
+_STORES_LOCK = Lock()
+
+
+class ChunkStore:
+    def __init__(self, path: Path):
+        self.path = path
+        self.refs_file = path / "refs.sqlite"
+        self.lock = Lock()
+        self._pending = Counter()
+
+        ensure_dir(self.path)
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS refs "
+                "(digest TEXT PRIMARY KEY, count INTEGER, dict_id INTEGER)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS manifests "
+                "(file TEXT PRIMARY KEY, dict_id INTEGER)"
+            )
+            columns = {row[1] for row in db.execute("PRAGMA table_info(refs)")}
+            if "dict_id" not in columns:
+                db.execute("ALTER TABLE refs ADD COLUMN dict_id INTEGER")
+                db.executemany(
+                    "UPDATE refs SET dict_id = ? WHERE digest = ?",
+                    (
+                        (self._dict_id(digest), digest)
+                        for (digest,) in db.execute(
+                            "SELECT digest FROM refs"
+                        ).fetchall()
+                    ),
+                )
+
+    def put(self, data: bytes, cctx: zstd.ZstdCompressor, pending: dict) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if digest not in pending:
+                pending[digest] = None
+                self._pending[digest] += 1
+
+        chunk_file = self._chunk_file(digest)
+        if not chunk_file.exists():
+            ensure_dir(chunk_file.parent)
+            temp_file = chunk_file.with_name(f"{chunk_file.name}.{os.getpid()}.tmp")
+            compressed = cctx.compress(data)
+            LIMITS.throttle(len(compressed))
+            temp_file.write_bytes(compressed)
+            os.replace(temp_file, chunk_file)
+            pending[digest] = _frame_dict_id(compressed)
+        elif pending[digest] is None:
+            pending[digest] = self._dict_id(digest)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        compressed = self._chunk_file(digest).read_bytes()
+        data = self.decompressor(compressed).decompress(compressed)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Chunk hash mismatch: {digest}")
+        return data
+
+    def decompressor(self, header: bytes) -> zstd.ZstdDecompressor:
+        return get_decompressor(self.path / DICT_DIR_NAME, header)
+
+    def commit(self, pending: dict, manifest_file: Path, dict_id: int):
+        with self.lock:
+            with self._connect() as db:
+                db.executemany(
+                    "INSERT INTO refs VALUES (?, 1, ?) "
+                    "ON CONFLICT(digest) DO UPDATE SET count = count + 1",
+                    pending.items(),
+                )
+                db.execute(
+                    "INSERT OR REPLACE INTO manifests VALUES (?, ?)",
+                    (str(manifest_file), dict_id),
+                )
+            self._forget(pending)
+
+    def abort(self, pending: dict):
+        with self.lock:
+            self._forget(pending)
+
+    def release(self, digests: set, manifest_file: Path) -> int:
+        removed = 0
+        with self.lock:
+            with self._connect() as db:
+                db.execute(
+                    "DELETE FROM manifests WHERE file = ?", (str(manifest_file),)
+                )
+                db.executemany(
+                    "UPDATE refs SET count = count - 1 WHERE digest = ?",
+                    ((digest,) for digest in digests),
+                )
+                unused = [
+                    row[0]
+                    for row in db.execute("SELECT digest FROM refs WHERE count <= 0")
+                    if row[0] not in self._pending
+                ]
+                db.executemany(
+                    "DELETE FROM refs WHERE digest = ?", ((d,) for d in unused)
+                )
+
+            for digest in unused:
+                self._chunk_file(digest).unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def dictionaries(self) -> set:
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT dict_id FROM refs UNION SELECT dict_id FROM manifests"
+            ).fetchall()
+        return {row[0] for row in rows if row[0]}
+
+    def _forget(self, pending: dict):
+        for digest in pending:
+            self._pending[digest] -= 1
+            if self._pending[digest] <= 0:
+                del self._pending[digest]
+
+    def _dict_id(self, digest: str) -> int:
+        try:
+            with open(self._chunk_file(digest), "rb") as f_in:
+                return _frame_dict_id(f_in.read(FRAME_HEADER_SIZE))
+        except (OSError, zstd.ZstdError):
+            return None
+
+    def _chunk_file(self, digest: str) -> Path:
+        return self.path / digest[:2] / f"{digest}.zst"
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.refs_file, timeout=60)
+
+
+def get_chunk_store(path: Path) -> ChunkStore:
+    path = path.resolve()
+    with _STORES_LOCK:
+        store = _STORES.get(path)
+        if store is None:
+            store = ChunkStore(path)
+            _STORES[path] = store
+        return store
+
+
+def write_snapshot(
+    store: ChunkStore,
+    root: Path,
+    manifest_file: Path,
+    cctx: zstd.ZstdCompressor,
+    store_cctx: zstd.ZstdCompressor = None,
+    path_filter: PathFilter = None,
+) -> tuple[str, list]:
+    pending = {}
+    entries = []
+    try:
+        for dir_path, dir_names, file_names in os.walk(root):
+            if path_filter is not None:
+                rel_dir = os.path.relpath(dir_path, root)
+                rel_dir = "" if rel_dir == "." else f"{rel_dir}/"
+                dir_names[:] = [
+                    name
+                    for name in dir_names
+                    if not path_filter.match(rel_dir + name, True)
+                ]
+                file_names = [
+                    name
+                    for name in file_names
+                    if not path_filter.match(rel_dir + name, False)
+                ]
+            dir_names.sort()
+            for name in sorted(dir_names + file_names):
+                path = os.path.join(dir_path, name)
+                try:
+                    entry = _snapshot_entry(
+                        store,
+                        root,
+                        path,
+                        store_cctx if store_cctx and is_compressed(name) else cctx,
+                        pending,
+                    )
+                except FileNotFoundError:
+                    continue
+                if entry is not None:
+                    entries.append(entry)
+
+        data = cctx.compress(json.dumps({"entries": entries}).encode())
+        manifest_temp_file = manifest_file.with_suffix(manifest_file.suffix + ".tmp")
+        try:
+            manifest_temp_file.write_bytes(data)
+            os.replace(manifest_temp_file, manifest_file)
+        finally:
+            manifest_temp_file.unlink(missing_ok=True)
+
+    except BaseException:
+        store.abort(pending)
+        raise
+
+    store.commit(pending, manifest_file, _frame_dict_id(data))
+    return hashlib.sha256(data).hexdigest(), entries
+
+
+def restore_snapshot(
+    store: ChunkStore, manifest_file: Path, dest: Path, paths: set = None
+):
+    directories = []
+    for entry in read_manifest(store, manifest_file)["entries"]:
+        if paths is not None and entry["path"] not in paths:
+            continue
+        path = dest / entry["path"]
+        if entry["type"] == "dir":
+            path.mkdir(parents=True, exist_ok=True)
+            directories.append((path, entry))
+            continue
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if entry["type"] == "symlink":
+            os.symlink(entry["target"], path)
+            os.utime(path, ns=(entry["mtime"], entry["mtime"]), follow_symlinks=False)
+            continue
+
+        with open(path, "wb") as f_out:
+            for digest in entry["chunks"]:
+                f_out.write(store.get(digest))
+        os.chmod(path, entry["mode"])
+        os.utime(path, ns=(entry["mtime"], entry["mtime"]))
+
+    for path, entry in reversed(directories):
+        os.chmod(path, entry["mode"])
+        os.utime(path, ns=(entry["mtime"], entry["mtime"]))
+
+
+def release_snapshot(store: ChunkStore, manifest_file: Path) -> int:
+    digests = set()
+    for entry in read_manifest(store, manifest_file)["entries"]:
+        digests.update(entry.get("chunks", []))
+    return store.release(digests, manifest_file)
+
+
+def read_manifest(store: ChunkStore, manifest_file: Path) -> dict:
+    with open(manifest_file, "rb") as f_in:
+        dctx = store.decompressor(f_in.read(FRAME_HEADER_SIZE))
+        f_in.seek(0)
+        with dctx.stream_reader(f_in) as reader:
+            return json.load(reader)
+
+
+def _snapshot_entry(
+    store: ChunkStore,
+    root: Path,
+    path: str,
+    cctx: zstd.ZstdCompressor,
+    pending: dict,
+) -> dict:
+    path_stat = os.lstat(path)
+    entry = {
+        "path": os.path.relpath(path, root),
+        "mode": stat.S_IMODE(path_stat.st_mode),
+        "mtime": path_stat.st_mtime_ns,
+    }
+
+    if stat.S_ISDIR(path_stat.st_mode):
+        entry["type"] = "dir"
+    elif stat.S_ISLNK(path_stat.st_mode):
+        entry["type"] = "symlink"
+        entry["target"] = os.readlink(path)
+    elif stat.S_ISREG(path_stat.st_mode):
+        entry["type"] = "file"
+        entry["size"] = path_stat.st_size
+        entry["chunks"] = []
+        with open(path, "rb") as f_in:
+            for data in iter(lambda: f_in.read(CHUNK_SIZE), b""):
+                entry["chunks"].append(store.put(data, cctx, pending))
+    else:
+        return None
+
+    return entry
+
+
+def _frame_dict_id(header: bytes) -> int:
+    return zstd.get_frame_parameters(header[:FRAME_HEADER_SIZE]).dict_id
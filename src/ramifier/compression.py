@@ -0,0 +1,132 @@
+import os
+
+import zstandard as zstd
+
+from .state import get_compression_stats, mark_compression_stats
+from .target import Target
+
+DEFAULT_LEVEL = 3
+MIN_LEVEL = -5
+MAX_LEVEL = 19
+STORE_LEVEL = -100
+STORE_MIN_SIZE = 1 << 16
+SPEED_SMOOTHING = 0.5
+
+COMPRESSED_SUFFIXES = frozenset(
+    {
+        ".7z",
+        ".avi",
+        ".br",
+        ".bz2",
+        ".flac",
+        ".gif",
+        ".gz",
+        ".heic",
+        ".jpeg",
+        ".jpg",
+        ".lz4",
+        ".lzma",
+        ".m4a",
+        ".mkv",
+        ".mov",
+        ".mp3",
+        ".mp4",
+        ".ogg",
+        ".opus",
+        ".png",
+        ".rar",
+        ".webm",
+        ".webp",
+        ".woff2",
+        ".xz",
+        ".zip",
+        ".zst",
+    }
+)
+
+
+def is_compressed(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in COMPRESSED_SUFFIXES
+
+
+def compressor(
+    target: Target, level: int, dictionary: zstd.ZstdCompressionDict = None
+) -> zstd.ZstdCompressor:
+    return zstd.ZstdCompressor(
+        level=level,
+        dict_data=dictionary,
+        threads=target.compression_threads,
+        write_checksum=True,
+    )
+
+
+def store_compressor() -> zstd.ZstdCompressor:
+    return zstd.ZstdCompressor(level=STORE_LEVEL, write_checksum=True)
+
+
+def choose_level(target: Target, raw_size: int) -> int:
+    if target.compression_level != "auto":
+        return target.compression_level
+
+    stats = get_compression_stats(target)
+    levels = {int(level): s for level, s in stats.get("levels", {}).items()}
+    if not levels:
+        return DEFAULT_LEVEL
+
+    fitting = [
+        level
+        for level, s in levels.items()
+        if _predicted_seconds(target, s, raw_size) <= target.compression_budget
+    ]
+    if not fitting:
+        fastest = min(levels)
+        return max(fastest - 1, MIN_LEVEL)
+
+    level = max(fitting)
+    seconds = _predicted_seconds(target, levels[level], raw_size)
+    if (
+        level < MAX_LEVEL
+        and level + 1 not in levels
+        and seconds * 2 <= target.compression_budget
+    ):
+        return level + 1
+    return level
+
+
+def record_compression(
+    target: Target,
+    level: int,
+    raw_size: int,
+    size: int,
+    seconds: float,
+    cpu_seconds: float,
+):
+    if target.compression_level != "auto" or raw_size <= 0:
+        return
+
+    stats = get_compression_stats(target)
+    levels = dict(stats.get("levels", {}))
+    previous = levels.get(str(level))
+    current = {
+        "speed": raw_size / max(seconds, 1e-3),
+        "cpu_speed": raw_size / max(cpu_seconds, 1e-3),
+        "ratio": size / raw_size,
+    }
+    if previous is not None:
+        current = {
+            key: previous[key] + (value - previous[key]) * SPEED_SMOOTHING
+            for key, value in current.items()
+        }
+    levels[str(level)] = current
+    mark_compression_stats(target, {"levels": levels, "last_level": level})
+
+
+def _predicted_seconds(target: Target, stats: dict, raw_size: int) -> float:
+    seconds = raw_size / stats["speed"]
+    if target.compression_cpu_budget > 0:
+        cpu_seconds = raw_size / stats["cpu_speed"]
+        seconds = max(
+            seconds,
+            cpu_seconds * target.compression_budget / target.compression_cpu_budget,
+        )
+    return seconds
@@ -1,37 +1,74 @@
+import os
 from pathlib import Path
 
 import yaml
 from xdg import BaseDirectory
 
 from .global_settings import GlobalSettings
-from .log import log_info
-from .target import Target
 
 CONFIG_FILE = Path(BaseDirectory.xdg_config_home) / "ramifier" / "config.yaml"
-if not CONFIG_FILE.exists():
-    raise FileNotFoundError(f"Config file not found: {CONFIG_FILE}")
+CONFIG_TEMP_FILE = CONFIG_FILE.with_suffix(".tmp")
 
-with CONFIG_FILE.open("r") as f_in:
-    CONFIG_DATA = yaml.safe_load(f_in)
 
+def read_config() -> dict:
+    if not CONFIG_FILE.exists():
+        raise FileNotFoundError(f"Config file not found: {CONFIG_FILE}")
 
-def load_global_settings() -> GlobalSettings:
-    s = CONFIG_DATA.get("global_settings", {})
+    with CONFIG_FILE.open("r") as f_in:
+        return yaml.safe_load(f_in) or {}
+
+
+def write_config(config: dict):
+    with CONFIG_TEMP_FILE.open("w") as f_out:
+        yaml.safe_dump(config, f_out, sort_keys=False)
+    os.replace(CONFIG_TEMP_FILE, CONFIG_FILE)
+
+
+def load_global_settings(config: dict) -> GlobalSettings:
+    s = config.get("global_settings", {})
     global_settings = GlobalSettings(
         ram_dir=s.get("ram_dir"),
         max_backups=s.get("max_backups", 3),
         interval=s.get("interval", {}),
         compression_level=s.get("compression_level", 3),
         compression_threads=s.get("compression_threads", 0),
+        compression_budget=s.get("compression_budget", 60),
+        compression_cpu_budget=s.get("compression_cpu_budget", 0),
+        dictionary=s.get("dictionary", False),
+        dictionary_size=s.get("dictionary_size", 112640),
+        full_backup_every=s.get("full_backup_every", 1),
+        backend=s.get("backend", "tar"),
+        chunk_store=s.get("chunk_store"),
+        restore_threads=s.get("restore_threads", 0),
+        move_threads=s.get("move_threads", 8),
+        shutdown_mode=s.get("shutdown_mode", "copy"),
+        snapshot=s.get("snapshot", False),
+        exclude=s.get("exclude", []),
+        include=s.get("include", []),
+        catalog=s.get("catalog", False),
+        lazy_restore=s.get("lazy_restore", False),
+        restore_priority=s.get("restore_priority", []),
+        tiered=s.get("tiered", False),
+        promote_threshold=s.get("promote_threshold", 3),
+        demote_after=s.get("demote_after", 3),
+        tier_interval=s.get("tier_interval", 300),
+        tier_size=s.get("tier_size", 0),
+        scheduler=s.get("scheduler", {}),
+        memory=s.get("memory", {}),
+        metrics=s.get("metrics", {}),
+        log_format=s.get("log_format", "text"),
     )
     return global_settings
 
 
-def load_targets(global_settings: GlobalSettings) -> list[Target]:
-    targets = []
-    for t in CONFIG_DATA.get("targets", []):
+def load_target_options(global_settings: GlobalSettings, config: dict) -> dict:
+    targets = {}
+    for t in config.get("targets", []):
         name = t.get("name")
-        target = Target(
+        if name in targets:
+            raise RuntimeError(f"Target with name {name} already exists")
+
+        targets[name] = dict(
             name=name,
             path=t.get("path"),
             backup_path=t.get("backup_path"),
@@ -43,11 +80,38 @@ def load_targets(global_settings: GlobalSettings) -> list[Target]:
             compression_threads=t.get(
                 "compression_threads", global_settings.compression_threads
             ),
+            compression_budget=t.get(
+                "compression_budget", global_settings.compression_budget
+            ),
+            compression_cpu_budget=t.get(
+                "compression_cpu_budget", global_settings.compression_cpu_budget
+            ),
+            dictionary=t.get("dictionary", global_settings.dictionary),
+            dictionary_size=t.get("dictionary_size", global_settings.dictionary_size),
+            full_backup_every=t.get(
+                "full_backup_every", global_settings.full_backup_every
+            ),
+            backend=t.get("backend", global_settings.backend),
+            chunk_store=global_settings.chunk_store,
+            restore_threads=t.get("restore_threads", global_settings.restore_threads),
+            move_threads=t.get("move_threads", global_settings.move_threads),
+            shutdown_mode=t.get("shutdown_mode", global_settings.shutdown_mode),
+            snapshot=t.get("snapshot", global_settings.snapshot),
+            exclude=global_settings.exclude + t.get("exclude", []),
+            include=global_settings.include + t.get("include", []),
+            catalog=t.get("catalog", global_settings.catalog),
+            lazy_restore=t.get("lazy_restore", global_settings.lazy_restore),
+            restore_priority=t.get(
+                "restore_priority", global_settings.restore_priority
+            ),
+            priority=t.get("priority", 0),
+            tiered=t.get("tiered", global_settings.tiered),
+            promote_threshold=t.get(
+                "promote_threshold", global_settings.promote_threshold
+            ),
+            demote_after=t.get("demote_after", global_settings.demote_after),
+            tier_interval=t.get("tier_interval", global_settings.tier_interval),
+            tier_size=t.get("tier_size", global_settings.tier_size),
             ram_path=global_settings.ram_dir / name,
         )
-        if name in [t.name for t in targets]:
-            raise RuntimeError(f"Target with name {name} already exists")
-
-        targets.append(target)
-        log_info("Target added", target.name)
     return targets
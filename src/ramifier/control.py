@@ -0,0 +1,64 @@
+import json
+import os
+import socket
+from pathlib import Path
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from threading import Thread
+
+from xdg import BaseDirectory
+
+from .log import log_warning
+
+CONTROL_SOCKET = Path(BaseDirectory.get_runtime_dir()) / "ramifier-control.sock"
+
+
+class ControlServer:
+    def __init__(self, commands: dict):
+        self.commands = commands
+        self._server = None
+
+    def start(self):
+        CONTROL_SOCKET.unlink(missing_ok=True)
+        self._server = ThreadingUnixStreamServer(str(CONTROL_SOCKET), _Handler)
+        self._server.daemon_threads = True
+        self._server.commands = self.commands
+        os.chmod(CONTROL_SOCKET, 0o600)
+        Thread(
+            target=self._server.serve_forever, name="ramifier-control", daemon=True
+        ).start()
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        CONTROL_SOCKET.unlink(missing_ok=True)
+
+
+class _Handler(StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            command = self.server.commands.get(request.get("command"))
+            if command is None:
+                raise ValueError(f"Unknown command: {request.get('command')}")
+            response = {"ok": True, "result": command(*request.get("args", []))}
+        except Exception as e:
+            log_warning(f"Control command failed: {e}")
+            response = {"ok": False, "error": str(e)}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+def send_command(command: str, *args):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(CONTROL_SOCKET))
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise RuntimeError(f"Ramifier is not running ({CONTROL_SOCKET})") from e
+        sock.sendall(json.dumps({"command": command, "args": args}).encode() + b"\n")
+        with sock.makefile("rb") as f_in:
+            response = json.loads(f_in.readline())
+
+    if not response["ok"]:
+        raise RuntimeError(response["error"])
+    return response["result"]
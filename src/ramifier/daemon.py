@@ -1,56 +1,387 @@
-from threading import Event, Thread
+import os
+import shutil
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
 
 import zstandard as zstd
 
 from .backup import backup_target, restore_target
+from .changes import get_detector
 from .interval import Interval
 from .log import log_error, log_info, log_warning
-from .runtime import create_symlink, remove_symlink
-from .state import get_running, mark_clean_exit, mark_running, mark_start
+from .memory import MEMORY
+from .metrics import METRICS
+from .runtime import (
+    SPEED_MIN_SIZE,
+    base_path,
+    create_symlink,
+    discard_symlink,
+    prefer_restore,
+    reconcile_base,
+    recover_base,
+    remove_symlink,
+)
+from .scheduler import Scheduler
+from .snapshot import drop_snapshot
+from .state import (
+    get_backups,
+    get_running,
+    get_stale,
+    mark_clean_exit,
+    mark_running,
+    mark_speed,
+    mark_stale,
+    mark_start,
+    mark_stopped,
+)
 from .target import Target
+from .tiered import Tier
+from .utils import get_tree_size
 
 
-def daemon(target: Target, stop_event: Event):
-    try:
-        running = get_running(target)
-        mark_start(target)
+class Daemon:
+    def __init__(self, target: Target, scheduler: Scheduler):
+        self.target = target
+        self.scheduler = scheduler
+        self.interval = None
+        self.tier = Tier(target, scheduler) if target.tiered else None
+        self.running = False
+        self.timings = {}
+
+        self._job = None
+        self._lock = Lock()
+        self._job_lock = Lock()
+        self._requested = None
+        self._pending_restore = None
+        self._deferred = False
+
+    def start(self, delay: float = 0):
+        self._job = self.scheduler.schedule(
+            delay, self._startup, self.target.priority, self.target.name
+        )
+        log_info("Daemon started", self.target.name)
 
-        if running:
+    def start_now(self):
+        log_info("Daemon started", self.target.name)
+        self._startup()
+
+    def stop(self):
+        if self._job is not None:
+            self.scheduler.cancel(self._job)
+        with self._lock:
+            if not self.running:
+                return
+
+            clean = False
             try:
-                restore_target(target)
-            except FileNotFoundError:
-                _safe_backup_target(target, True)
-        else:
-            _safe_backup_target(target, True)
+                self._wait_for_restore()
+                _safe_backup_target(self.target)
+                clean = True
+            except Exception as e:
+                log_error(f"Daemon terminated due to error: {e}", self.target.name)
+            finally:
+                self._shutdown(clean)
+            if clean:
+                mark_clean_exit(self.target)
+
+    def status(self) -> dict:
+        backups = get_backups(self.target)
+        files, size = get_detector(self.target).dirty_size() if self.running else (0, 0)
+        job = self._job
+        return {
+            "name": self.target.name,
+            "path": str(self.target.path),
+            "running": self.running,
+            "deferred": self._deferred,
+            "tiered": self.target.tiered,
+            "ram_bytes": MEMORY.usage(self.target) if self.running else 0,
+            "backups": len(backups),
+            "backup_size_bytes": sum(_file_size(b["file"]) for b in backups),
+            "last_backup": backups[-1]["file"] if backups else None,
+            "last_backup_size_bytes": (
+                _file_size(backups[-1]["file"]) if backups else 0
+            ),
+            "next_backup": (
+                max(job.due - monotonic(), 0)
+                if self.running and job is not None
+                else None
+            ),
+            "at_risk_files": files,
+            "at_risk_bytes": size,
+        }
 
-        create_symlink(target)
+    def collect_metrics(self):
+        status = self.status()
+        for name in (
+            "backups",
+            "backup_size_bytes",
+            "last_backup_size_bytes",
+            "at_risk_files",
+            "at_risk_bytes",
+        ):
+            METRICS.set(name, status[name], self.target.name)
+        METRICS.set("running", int(self.running), self.target.name)
 
-        mark_running(target)
+    def update(self, options: dict):
+        with self._lock:
+            self.target.update(options)
+            if self.running and "interval" in options:
+                self.interval.stop()
+                self.interval = Interval(
+                    self.target, self.scheduler, self._reschedule_backup
+                )
+                delay = self.interval.get_interval() * 60
+                with self._job_lock:
+                    if self._job is not None:
+                        self.scheduler.cancel(self._job)
+                        self._job = self.scheduler.schedule(
+                            delay, self._backup, self.target.priority, self.target.name
+                        )
+        log_info(
+            f"Configuration updated: {', '.join(sorted(options))}", self.target.name
+        )
 
-        target_interval = Interval(target)
-        while not stop_event.is_set():
-            interval = target_interval.get_interval()
-            stop_event.wait(interval * 60)
-            _safe_backup_target(target)
+    def backup_now(self) -> bool:
+        if not self.running:
+            return False
+        self._reschedule_backup(0)
+        return True
+
+    def demote(self):
+        with self._lock:
+            if not self.running:
+                return
+
+            try:
+                self._wait_for_restore()
+                _safe_backup_target(self.target)
+            except Exception as e:
+                log_error(f"Daemon terminated due to error: {e}", self.target.name)
+                self._shutdown()
+                return
+
+            self._shutdown(True)
+            mark_stopped(self.target)
+            self._defer()
+
+    def _startup(self):
+        with self._job_lock:
+            self._job = None
+        with self._lock:
+            self.timings = {}
+            started = monotonic()
+            try:
+                running = get_running(self.target)
+                stale = self.tier is None and (
+                    get_stale(self.target) or recover_base(self.target)
+                )
+                mark_start(self.target)
 
-        mark_clean_exit(target)
+                in_ram = False
+                if stale:
+                    if not self._admit(get_tree_size(self.target.path)):
+                        return
+                    with self._phase("restore"):
+                        in_ram = self._reconcile()
+                elif running:
+                    try:
+                        restore_started = monotonic()
+                        with self._phase("restore"):
+                            self._pending_restore = restore_target(self.target)
+                        if self._pending_restore is None:
+                            _mark_restore_speed(
+                                self.target,
+                                get_tree_size(self.target.data_path),
+                                restore_started,
+                            )
+                    except FileNotFoundError:
+                        with self._phase("backup"):
+                            _safe_backup_target(self.target, True)
+                elif not self._deferred:
+                    with self._phase("backup"):
+                        _safe_backup_target(self.target, True)
 
-    except Exception as e:
-        log_error(f"Daemon terminated due to error: {e}", target.name)
-        return
+                in_ram = in_ram or self._pending_restore is not None
+                if not in_ram and not self._admit(get_tree_size(self.target.data_path)):
+                    return
 
-    finally:
+                self._deferred = False
+                with self._phase("ramify"):
+                    if self.tier is not None:
+                        self.tier.start()
+                    else:
+                        create_symlink(self.target, in_ram)
+                if self._pending_restore is None:
+                    with self._phase("scan"):
+                        get_detector(self.target).refresh()
+
+                mark_running(self.target)
+                self.running = True
+
+                self.interval = Interval(
+                    self.target, self.scheduler, self._reschedule_backup
+                )
+                self._schedule_backup()
+
+                self.timings["total"] = monotonic() - started
+                METRICS.observe("startup", self.timings["total"], self.target.name)
+                log_info(
+                    f"Started in {self.timings['total']:.1f}s ("
+                    + ", ".join(
+                        f"{phase} {seconds:.1f}s"
+                        for phase, seconds in self.timings.items()
+                        if phase != "total"
+                    )
+                    + ")",
+                    self.target.name,
+                )
+
+            except Exception as e:
+                log_error(f"Daemon terminated due to error: {e}", self.target.name)
+                self._shutdown()
+
+    @contextmanager
+    def _phase(self, phase: str):
+        started = monotonic()
         try:
-            remove_symlink(target)
-        except FileNotFoundError as e:
-            log_warning(e, target.name)
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0) + monotonic() - started
+
+    def _backup(self):
+        with self._job_lock:
+            self._job = None
+        with self._lock:
+            if not self.running:
+                return
+
+            try:
+                self._wait_for_restore()
+                _safe_backup_target(self.target)
+                if self.tier is not None:
+                    self.tier.release_shadows()
+                self._schedule_backup()
+
+            except Exception as e:
+                log_error(f"Daemon terminated due to error: {e}", self.target.name)
+                self._shutdown()
+
+    def _schedule_backup(self):
+        delay = self.interval.get_interval() * 60
+        with self._job_lock:
+            if self._requested is not None:
+                delay = min(delay, max(self._requested - monotonic(), 0))
+                self._requested = None
+            self._job = self.scheduler.schedule(
+                delay, self._backup, self.target.priority, self.target.name
+            )
 
+    def _reschedule_backup(self, delay: float):
+        with self._job_lock:
+            if not self.running:
+                return
+            if self._job is None:
+                due = monotonic() + delay
+                self._requested = min(self._requested or due, due)
+                return
+            if self._job.due <= monotonic() + delay:
+                return
 
-def start_daemon(target: Target, stop_event: Event) -> Thread:
-    thread = Thread(target=daemon, args=(target, stop_event))
-    thread.start()
-    log_info("Daemon started", target.name)
-    return thread
+            self.scheduler.cancel(self._job)
+            self._job = self.scheduler.schedule(
+                delay, self._backup, self.target.priority, self.target.name
+            )
+
+    def _admit(self, size: int) -> bool:
+        if MEMORY.admit(self.target, size):
+            return True
+        mark_stopped(self.target)
+        self._defer()
+        return False
+
+    def _reconcile(self) -> bool:
+        try:
+            restore_target(self.target, lazy=False, root=self.target.ram_path)
+        except FileNotFoundError:
+            log_warning(
+                "No valid backup found, keeping the on-disk copy", self.target.name
+            )
+            mark_stale(self.target, False)
+            _safe_backup_target(self.target, True)
+            return False
+
+        reconcile_base(self.target)
+        mark_stale(self.target, False)
+        return True
+
+    def _defer(self):
+        self._deferred = True
+        self._job = self.scheduler.schedule(
+            MEMORY.retry, self._startup, self.target.priority, self.target.name
+        )
+
+    def _wait_for_restore(self):
+        if self._pending_restore is not None:
+            self._pending_restore.wait()
+            self._pending_restore = None
+            get_detector(self.target).refresh()
+
+    def _restore_from_backup(self) -> bool:
+        detector = get_detector(self.target)
+        if detector.is_dirty():
+            return False
+
+        size = detector.total_size()
+        started = monotonic()
+        temp_path = self.target.path.with_name(
+            f".{self.target.path.name}.ramifier-restore"
+        )
+        try:
+            restore_target(self.target, lazy=False, root=temp_path)
+        except Exception as e:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            log_warning(
+                f"Restore from backup failed, copying from RAM: {e}", self.target.name
+            )
+            return False
+
+        self.target.path.unlink()
+        os.rename(temp_path, self.target.path)
+        _mark_restore_speed(self.target, size, started)
+        shutil.rmtree(self.target.ram_path)
+        log_info("Restored from backup instead of copying from RAM", self.target.name)
+        return True
+
+    def _discard(self) -> bool:
+        if get_detector(self.target).is_dirty() or not base_path(self.target).exists():
+            return False
+
+        mark_stale(self.target, True)
+        discard_symlink(self.target)
+        return True
+
+    def _fast_shutdown(self) -> bool:
+        if self.target.shutdown_mode == "discard":
+            return self._discard()
+        if self.target.shutdown_mode == "copy" and prefer_restore(self.target):
+            return self._restore_from_backup()
+        return False
+
+    def _shutdown(self, clean: bool = False):
+        self.running = False
+        MEMORY.release(self.target)
+        if self.interval is not None:
+            self.interval.stop()
+        drop_snapshot(self.target)
+
+        try:
+            if self.tier is not None:
+                self.tier.stop()
+            elif not (clean and self._fast_shutdown()):
+                remove_symlink(self.target)
+        except FileNotFoundError as e:
+            log_warning(e, self.target.name)
 
 
 def _safe_backup_target(target: Target, force: bool = False):
@@ -60,3 +391,15 @@ def _safe_backup_target(target: Target, force: bool = False):
         raise RuntimeError("Filesystem error during backup") from e
     except zstd.ZstdError as e:
         raise RuntimeError("Compression error during backup") from e
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def _mark_restore_speed(target: Target, size: int, started: float):
+    if size >= SPEED_MIN_SIZE:
+        mark_speed(target, "restore", size / max(monotonic() - started, 1e-3))
@@ -0,0 +1,117 @@
+import os
+import random
+import stat
+import time
+from pathlib import Path
+from threading import Lock
+
+import zstandard as zstd
+
+from .log import log_info, log_warning
+from .state import get_dictionary_id, mark_dictionary
+from .target import Target
+from .utils import ensure_dir
+
+DICT_DIR_NAME = "dicts"
+FRAME_HEADER_SIZE = 18
+DICT_MAX_AGE = 7 * 24 * 60 * 60
+SAMPLE_LIMIT = 4096
+SAMPLE_MAX_SIZE = 1 << 16
+
+_DICTS = {}
+_DICTS_LOCK = Lock()
+
+
+def dictionary_dir(target: Target) -> Path:
+    return target.chunk_store / DICT_DIR_NAME
+
+
+def get_dictionary(target: Target, files: dict, full: bool) -> zstd.ZstdCompressionDict:
+    if not target.dictionary or target.backend != "chunks":
+        return None
+
+    dict_dir = dictionary_dir(target)
+    dict_id = get_dictionary_id(target)
+    dict_file = dict_dir / f"{dict_id}.zdict"
+    if full and (
+        dict_id is None
+        or not dict_file.exists()
+        or time.time() - dict_file.stat().st_mtime > DICT_MAX_AGE
+    ):
+        dict_id = _train_dictionary(target, files) or dict_id
+
+    if dict_id is None:
+        return None
+    try:
+        return load_dictionary(dict_dir, dict_id)
+    except FileNotFoundError:
+        log_warning(f"Dictionary not found: {dict_id}", target.name)
+        return None
+
+
+def load_dictionary(dict_dir: Path, dict_id: int) -> zstd.ZstdCompressionDict:
+    dict_file = dict_dir / f"{dict_id}.zdict"
+    with _DICTS_LOCK:
+        dictionary = _DICTS.get(dict_file)
+        if dictionary is None:
+            dictionary = zstd.ZstdCompressionDict(dict_file.read_bytes())
+            _DICTS[dict_file] = dictionary
+        return dictionary
+
+
+def get_decompressor(dict_dir: Path, header: bytes) -> zstd.ZstdDecompressor:
+    dict_id = zstd.get_frame_parameters(header).dict_id
+    if not dict_id:
+        return zstd.ZstdDecompressor()
+    return zstd.ZstdDecompressor(dict_data=load_dictionary(dict_dir, dict_id))
+
+
+def prune_dictionaries(target: Target, keep: set):
+    dict_dir = dictionary_dir(target)
+    if not dict_dir.exists():
+        return
+
+    keep = {f"{dict_id}.zdict" for dict_id in keep}
+    for dict_file in dict_dir.glob("*.zdict"):
+        if (
+            dict_file.name not in keep
+            and time.time() - dict_file.stat().st_mtime > DICT_MAX_AGE
+        ):
+            dict_file.unlink(missing_ok=True)
+            log_info(f"Deleted old dictionary: {dict_file}", target.name)
+
+
+def _train_dictionary(target: Target, files: dict) -> int:
+    root = target.data_path.resolve()
+    candidates = [
+        rel
+        for rel, entry in files.items()
+        if stat.S_ISREG(entry[3]) and 0 < entry[0] <= SAMPLE_MAX_SIZE
+    ]
+    samples = []
+    for rel in random.sample(candidates, min(len(candidates), SAMPLE_LIMIT)):
+        try:
+            samples.append((root / rel).read_bytes())
+        except OSError:
+            continue
+
+    try:
+        dictionary = zstd.train_dictionary(target.dictionary_size, samples)
+    except zstd.ZstdError as e:
+        log_warning(f"Dictionary training failed: {e}", target.name)
+        return None
+
+    dict_dir = dictionary_dir(target)
+    ensure_dir(dict_dir)
+    dict_id = dictionary.dict_id()
+    dict_file = dict_dir / f"{dict_id}.zdict"
+    dict_temp_file = dict_file.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        dict_temp_file.write_bytes(dictionary.as_bytes())
+        os.replace(dict_temp_file, dict_file)
+    finally:
+        dict_temp_file.unlink(missing_ok=True)
+
+    mark_dictionary(target, dict_id)
+    log_info(f"Trained dictionary {dict_id} from {len(samples)} samples", target.name)
+    return dict_id
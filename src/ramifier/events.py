@@ -0,0 +1,58 @@
+import select
+from threading import Lock, Thread
+from time import sleep
+
+from .log import log_error
+
+COALESCE_DELAY = 0.5
+
+
+class EventLoop:
+    def __init__(self):
+        self._epoll = None
+        self._callbacks = {}
+        self._lock = Lock()
+        self._thread = None
+
+    def register(self, fd: int, callback):
+        with self._lock:
+            if self._epoll is None:
+                self._epoll = select.epoll()
+                self._thread = Thread(
+                    target=self._run, name="ramifier-events", daemon=True
+                )
+                self._thread.start()
+
+            self._remove(fd)
+            self._callbacks[fd] = callback
+            self._epoll.register(fd, select.EPOLLIN)
+
+    def unregister(self, fd: int):
+        with self._lock:
+            self._remove(fd)
+
+    def _remove(self, fd: int):
+        if self._callbacks.pop(fd, None) is not None:
+            try:
+                self._epoll.unregister(fd)
+            except (OSError, ValueError):
+                pass
+
+    def _run(self):
+        while True:
+            ready = self._epoll.poll()
+            sleep(COALESCE_DELAY)
+            for fd, _ in ready:
+                with self._lock:
+                    callback = self._callbacks.get(fd)
+                if callback is None:
+                    continue
+
+                try:
+                    callback()
+                except Exception as e:
+                    log_error(f"Event handler failed: {e}")
+                    self.unregister(fd)
+
+
+EVENT_LOOP = EventLoop()
@@ -0,0 +1,84 @@
+import re
+
+
+class PathFilter:
+    def __init__(self, exclude: list, include: list):
+        rules = [(pattern, False) for pattern in exclude]
+        rules += [(pattern, True) for pattern in include]
+        self._rules = [
+            rule
+            for rule in (_compile(pattern, keep) for pattern, keep in rules)
+            if rule is not None
+        ]
+        self._rules.reverse()
+
+    def match(self, rel: str, is_dir: bool) -> bool:
+        for regex, keep, dir_only in self._rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel):
+                return not keep
+        return False
+
+    def empty(self) -> bool:
+        return not self._rules
+
+
+def _compile(pattern: str, keep: bool) -> tuple:
+    pattern = pattern.rstrip(" ")
+    if not pattern or pattern.startswith("#"):
+        return None
+    if pattern.startswith("!"):
+        keep = not keep
+        pattern = pattern[1:]
+    elif pattern.startswith("\\"):
+        pattern = pattern[1:]
+
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    if not pattern:
+        return None
+
+    regex = _translate(pattern)
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    return re.compile(regex + r"\Z", re.DOTALL), keep, dir_only
+
+
+def _translate(pattern: str) -> str:
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**", i) and (i == 0 or pattern[i - 1] == "/"):
+            if pattern.startswith("**/", i):
+                regex.append("(?:.*/)?")
+                i += 3
+                continue
+            if i + 2 == len(pattern):
+                regex.append(".*")
+                i += 2
+                continue
+        if c == "*":
+            regex.append("[^/]*")
+        elif c == "?":
+            regex.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end == -1:
+                regex.append(re.escape(c))
+            else:
+                chars = pattern[i + 1 : end]
+                if chars[0] in "!^":
+                    chars = "^" + chars[1:]
+                regex.append("[" + chars.replace("\\", "\\\\") + "]")
+                i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return "".join(regex)
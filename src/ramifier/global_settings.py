@@ -1,5 +1,8 @@
 import os
 from pathlib import Path
+from typing import Union
+
+from xdg import BaseDirectory
 
 from .utils import ensure_dir, get_ram_dir
 
@@ -9,17 +12,108 @@ class GlobalSettings:
         self,
         max_backups: int,
         interval: dict,
-        compression_level: int,
+        compression_level: Union[int, str],
         compression_threads: int,
+        compression_budget: float,
+        compression_cpu_budget: float,
+        dictionary: bool,
+        dictionary_size: int,
+        full_backup_every: int,
+        backend: str,
+        chunk_store: str,
+        restore_threads: int,
+        move_threads: int,
+        shutdown_mode: str,
+        snapshot: bool,
+        exclude: list,
+        include: list,
+        catalog: bool,
+        lazy_restore: bool,
+        restore_priority: list,
+        tiered: bool,
+        promote_threshold: int,
+        demote_after: int,
+        tier_interval: int,
+        tier_size: int,
+        scheduler: dict,
+        memory: dict,
+        metrics: dict,
+        log_format: str,
         ram_dir: str,
     ):
         self.max_backups = max_backups
         self.interval = interval
         self.compression_level = compression_level
         self.compression_threads = compression_threads
+        self.compression_budget = compression_budget
+        self.compression_cpu_budget = compression_cpu_budget
+        self.dictionary = dictionary
+        self.dictionary_size = dictionary_size
+        self.full_backup_every = full_backup_every
+        self.backend = backend
+        self.restore_threads = restore_threads
+        self.move_threads = move_threads
+        self.shutdown_mode = shutdown_mode
+        self.snapshot = snapshot
+        self.exclude = exclude
+        self.include = include
+        self.catalog = catalog
+        self.lazy_restore = lazy_restore
+        self.restore_priority = restore_priority
+        self.tiered = tiered
+        self.promote_threshold = promote_threshold
+        self.demote_after = demote_after
+        self.tier_interval = tier_interval
+        self.tier_size = tier_size
+        self.scheduler = {
+            "workers": scheduler.get("workers", 4),
+            "max_compressions": scheduler.get("max_compressions", 2),
+            "executor": scheduler.get("executor", "thread"),
+            "max_jobs": scheduler.get("max_jobs", 0),
+            "io_limit": scheduler.get("io_limit", 0),
+            "jitter": scheduler.get("jitter", 0.1),
+            "startup_jobs": scheduler.get("startup_jobs", 4),
+            "startup_per_device": scheduler.get("startup_per_device", 2),
+        }
+        self.memory = {
+            "ram_budget": memory.get("ram_budget", 0),
+            "min_available": memory.get("min_available", 256),
+            "psi_threshold": memory.get("psi_threshold", 10.0),
+            "check_interval": memory.get("check_interval", 10),
+            "retry": memory.get("retry", 300),
+            "demote": memory.get("demote", False),
+        }
+        self.metrics = {
+            "listen": _expand_listen(
+                metrics.get(
+                    "listen",
+                    str(
+                        Path(BaseDirectory.get_runtime_dir()) / "ramifier-metrics.sock"
+                    ),
+                )
+            ),
+        }
+        self.log_format = log_format
+        if chunk_store is None:
+            self.chunk_store = Path(BaseDirectory.xdg_data_home) / "ramifier" / "chunks"
+        else:
+            self.chunk_store = Path(os.path.expandvars(chunk_store)).expanduser()
         if ram_dir is None:
             self.ram_dir = get_ram_dir()
         else:
             ram_dir = Path(os.path.expandvars(ram_dir)).expanduser() / "ramifier"
             ensure_dir(ram_dir, 0o700)
             self.ram_dir = ram_dir
+
+
+def _expand_listen(listen: str) -> str:
+    if not listen:
+        return listen
+    listen = os.path.expanduser(os.path.expandvars(listen))
+    if listen.startswith("/"):
+        return listen
+
+    _, _, port = listen.rpartition(":")
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"Invalid metrics listen address: {listen}")
+    return listen
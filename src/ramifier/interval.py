@@ -1,11 +1,12 @@
 from math import ceil, log
-from threading import Thread
-from time import sleep
+from threading import Lock
+from time import monotonic
 
+from .changes import get_detector
 from .log import log_info, log_warning
+from .scheduler import Scheduler
 from .state import get_hash_history, set_hash_history_len
 from .target import Target
-from .utils import get_tree_state_hash
 
 
 class Interval:
@@ -13,9 +14,16 @@ class Interval:
     default_min_interval = 5
     default_max_interval = 100
     default_hash_history_len = 5
+    default_half_life = 5
+    default_quiet = 30
+    default_max_files = 1000
+    default_max_bytes = 64 << 20
+    default_risk_poll = 60
 
-    def __init__(self, target: Target):
+    def __init__(self, target: Target, scheduler: Scheduler, reschedule=None):
         self.target = target
+        self.scheduler = scheduler
+        self.reschedule = reschedule
         self.interval_dict = target.interval
 
         hash_history_len = max(
@@ -23,13 +31,25 @@ class Interval:
         )
         set_hash_history_len(self.target, hash_history_len)
 
-        self._smart_interval_thread = None
+        self._smart_job = None
+        self._quiet_job = None
+        self._risk_job = None
+        self._at_risk = False
+        self._lock = Lock()
+        self._listener = None
+        self._events = 0.0
+        self._bytes = 0.0
+        self._rate_time = monotonic()
+        self._last_interval = monotonic()
 
     def get_interval(self) -> int:
         mode = self.interval_dict.get("mode", "static")
         max_interval = self.interval_dict.get("max", Interval.default_max_interval)
         min_interval = self.interval_dict.get("min", Interval.default_min_interval)
 
+        self._last_interval = monotonic()
+        self._at_risk = False
+
         if mode == "static":
             return self.interval_dict.get("value", Interval.default_interval)
 
@@ -37,15 +57,41 @@ class Interval:
             return self._dynamic_interval(max_interval, min_interval)
 
         elif mode == "smart":
-            if self._smart_interval_thread is None:
+            if self._smart_job is None:
                 self._start_smart_interval(max_interval, min_interval)
                 return self._dynamic_interval(max_interval, min_interval)
             else:
                 return self.current_smart_interval
 
+        elif mode == "event":
+            self._listen(self._on_events)
+            return self._event_interval(max_interval, min_interval)
+
+        elif mode == "risk":
+            self._listen(self._check_risk)
+            if self._risk_job is None and not get_detector(self.target).watching():
+                self._poll_risk()
+            return max_interval
+
         else:
             raise ValueError(f"Unknown interval mode: {mode}")
 
+    def stop(self):
+        if self._smart_job is not None:
+            self.scheduler.cancel(self._smart_job)
+        if self._quiet_job is not None:
+            self.scheduler.cancel(self._quiet_job)
+        if self._risk_job is not None:
+            self.scheduler.cancel(self._risk_job)
+        if self._listener is not None:
+            get_detector(self.target).remove_listener(self._listener)
+            self._listener = None
+
+    def _listen(self, listener):
+        if self._listener is None:
+            get_detector(self.target).add_listener(listener)
+            self._listener = listener
+
     def _dynamic_interval(self, max_interval: int, min_interval: int) -> int:
         hash_history = get_hash_history(self.target)
         unique_count = len(set(hash_history))
@@ -64,41 +110,113 @@ class Interval:
         return final_interval
 
     def _start_smart_interval(self, max_interval: int, min_interval: int):
-        self._smart_interval_thread = Thread(
-            target=self._smart_interval,
-            args=(max_interval, min_interval),
-            daemon=True,
-        )
-        self._smart_interval_thread.start()
+        self._smart_hash = get_detector(self.target).state_hash()
+        self._intensity = 1
+        self._smart_interval(max_interval, min_interval, True)
+
+    def _smart_interval(
+        self, max_interval: int, min_interval: int, just_started: bool = False
+    ):
+        new_hash = get_detector(self.target).state_hash()
 
-    def _smart_interval(self, max_interval: int, min_interval: int):
-        just_started = True
+        has_changes = new_hash != self._smart_hash
+        self._smart_hash = new_hash
+
+        if has_changes:
+            self._intensity += 1
+        else:
+            decay = ceil(log(self._intensity)) if self._intensity > 1 else 0
+            self._intensity = max(1, self._intensity - decay)
+
+        self.current_smart_interval = int(
+            max(max_interval / self._intensity, min_interval)
+        )
+        if not just_started:
+            log_info(
+                f"Smart interval updated: {self.current_smart_interval} minutes (intensity={self._intensity})",
+                self.target.name,
+            )
 
         check_interval = max(min_interval // 2, (max_interval - min_interval) // 6, 1)
-        current_hash = get_tree_state_hash(self.target.path)
+        self._smart_job = self.scheduler.schedule(
+            check_interval * 60,
+            lambda: self._smart_interval(max_interval, min_interval),
+            self.target.priority,
+            self.target.name,
+        )
 
-        intensity = 1
-        while True:
-            new_hash = get_tree_state_hash(self.target.path)
+    def _event_interval(self, max_interval: int, min_interval: int) -> int:
+        if not get_detector(self.target).watching():
+            return self._dynamic_interval(max_interval, min_interval)
 
-            has_changes = new_hash != current_hash
-            current_hash = new_hash
+        with self._lock:
+            events, size = self._event_rate()
+        activity = events + size / (1 << 20)
+        interval = int(max(max_interval / (1 + activity), min_interval, 1))
+        log_info(
+            f"Event interval updated: {interval} minutes "
+            f"({events:.1f} events/min, {size / 1024:.0f} KiB/min)",
+            self.target.name,
+        )
+        return interval
+
+    def _on_events(self, events: int, size: int):
+        with self._lock:
+            self._event_rate()
+            self._events += events
+            self._bytes += size
+
+            if self._quiet_job is not None:
+                self.scheduler.cancel(self._quiet_job)
+            self._quiet_job = self.scheduler.schedule(
+                self.interval_dict.get("quiet", Interval.default_quiet),
+                self._burst_end,
+                self.target.priority,
+                self.target.name,
+            )
 
-            if has_changes:
-                intensity += 1
-            else:
-                decay = ceil(log(intensity)) if intensity > 1 else 0
-                intensity = max(1, intensity - decay)
+    def _burst_end(self):
+        self._quiet_job = None
+        if self.reschedule is None or not get_detector(self.target).is_dirty():
+            return
 
-            self.current_smart_interval = int(
-                max(max_interval / intensity, min_interval)
+        min_interval = self.interval_dict.get("min", Interval.default_min_interval)
+        self.reschedule(max(self._last_interval + min_interval * 60 - monotonic(), 0))
+
+    def _event_rate(self) -> tuple[float, float]:
+        half_life = self.interval_dict.get("half_life", Interval.default_half_life)
+        now = monotonic()
+        decay = 0.5 ** ((now - self._rate_time) / (half_life * 60))
+        self._events *= decay
+        self._bytes *= decay
+        self._rate_time = now
+
+        scale = log(2) / half_life
+        return self._events * scale, self._bytes * scale
+
+    def _check_risk(self, events: int = 0, size: int = 0):
+        dirty_files, dirty_bytes = get_detector(self.target).dirty_size()
+        max_files = self.interval_dict.get("max_files", Interval.default_max_files)
+        max_bytes = self.interval_dict.get("max_bytes", Interval.default_max_bytes)
+        if self._at_risk or (dirty_files < max_files and dirty_bytes < max_bytes):
+            return
+
+        self._at_risk = True
+        log_info(
+            f"Data at risk: {dirty_files} files, {dirty_bytes // 1024} KiB",
+            self.target.name,
+        )
+        if self.reschedule is not None:
+            min_interval = self.interval_dict.get("min", 0)
+            self.reschedule(
+                max(self._last_interval + min_interval * 60 - monotonic(), 0)
             )
-            if not just_started:
-                log_info(
-                    f"Smart interval updated: {self.current_smart_interval} minutes (intensity={intensity})",
-                    self.target.name,
-                )
-            else:
-                just_started = False
 
-            sleep(check_interval * 60)
+    def _poll_risk(self):
+        self._check_risk()
+        self._risk_job = self.scheduler.schedule(
+            self.interval_dict.get("poll", Interval.default_risk_poll),
+            self._poll_risk,
+            self.target.priority,
+            self.target.name,
+        )
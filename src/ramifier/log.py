@@ -1,16 +1,39 @@
+import json
 import logging
 import sys
+from datetime import datetime
 
 logger = logging.getLogger("ramifier")
 logger.setLevel(logging.INFO)
+formatter = logging.Formatter("[%(levelname)s] [%(prefix)s] %(message)s")
 
 if not logger.hasHandlers():
     handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter("[%(levelname)s] [%(prefix)s] %(message)s")
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
 
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(
+            {
+                "time": datetime.fromtimestamp(record.created).isoformat(
+                    timespec="milliseconds"
+                ),
+                "level": record.levelname,
+                "target": getattr(record, "prefix", "ramifier"),
+                "message": record.getMessage(),
+            }
+        )
+
+
+def set_log_format(log_format: str):
+    if log_format not in ("text", "json"):
+        raise ValueError(f"Unknown log format: {log_format}")
+    for handler in logger.handlers:
+        handler.setFormatter(JsonFormatter() if log_format == "json" else formatter)
+
+
 def log_info(message: str, prefix: str = "ramifier"):
     logger.info(message, extra={"prefix": prefix})
 
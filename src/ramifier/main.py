@@ -1,23 +1,69 @@
+import argparse
+import json
+import os
 import signal
 import sys
+import tarfile
+from datetime import datetime
+from pathlib import Path
 from threading import Event
 
+import yaml
+import zstandard as zstd
+
 from . import __version__
-from .config import load_global_settings, load_targets
-from .daemon import start_daemon
+from .catalog import catalog_exists, extract_entries, get_catalog
+from .config import load_global_settings, load_target_options, read_config
+from .control import ControlServer, send_command
 from .lock import acquire_lock, release_lock
 from .log import log_error, log_info
-from .state import load_state
+from .memory import MEMORY
+from .metrics import METRICS, MetricsServer
+from .orchestrator import build_targets
+from .scheduler import Scheduler
+from .state import flush_state, load_state
+from .supervisor import Supervisor, configure
+from .workers import WORKERS
 
 
 def main():
+    args = _parse_args()
+    if args.command in (None, "run"):
+        run()
+        return
+    if args.command in ("history", "extract"):
+        _catalog_command(args)
+        return
+
+    try:
+        result = send_command(args.command, *_command_args(args))
+    except (RuntimeError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(result, indent=4))
+    elif args.command == "status":
+        _print_status(result)
+    elif isinstance(result, dict):
+        for kind, names in result.items():
+            if names:
+                print(f"{kind.capitalize()}: {', '.join(names)}")
+    else:
+        print(result)
+
+
+def run():
     log_info(f"Version: {__version__}")
 
     try:
         acquire_lock()
 
-        global_settings = load_global_settings()
-        targets = load_targets(global_settings)
+        config = read_config()
+        global_settings = load_global_settings(config)
+        options = load_target_options(global_settings, config)
+        configure(global_settings)
+        targets = build_targets(global_settings, options)
 
         load_state()
 
@@ -25,17 +71,211 @@ def main():
         log_error(f"Ramifier terminated due to error: {e}")
         sys.exit(1)
 
+    settings = global_settings.scheduler
+    scheduler = Scheduler(settings["workers"], settings["jitter"])
+    supervisor = Supervisor(scheduler)
     stop_event = Event()
 
     def handle_termination(sig, frame):
         stop_event.set()
 
+    def handle_reload(sig, frame):
+        scheduler.schedule(0, supervisor.reload, 100, "reload")
+
     signal.signal(signal.SIGINT, handle_termination)
     signal.signal(signal.SIGTERM, handle_termination)
+    signal.signal(signal.SIGHUP, handle_reload)
 
-    threads = [start_daemon(target, stop_event) for target in targets]
+    METRICS.add_collector(MEMORY.update_gauges)
+    METRICS.add_collector(
+        lambda: [daemon.collect_metrics() for daemon in list(supervisor.daemons)]
+    )
+    servers = []
+    if global_settings.metrics["listen"]:
+        servers.append(MetricsServer(global_settings.metrics["listen"]))
+    servers.append(
+        ControlServer(
+            {
+                "status": supervisor.status,
+                "backup": supervisor.backup,
+                "reload": supervisor.reload,
+                "add": supervisor.add,
+                "remove": supervisor.remove,
+            }
+        )
+    )
+    for server in servers:
+        try:
+            server.start()
+        except OSError as e:
+            log_error(f"Failed to start {type(server).__name__}: {e}")
 
-    for thread in threads:
-        thread.join()
+    scheduler.start()
+    MEMORY.start(scheduler, supervisor.daemons)
+    supervisor.start(
+        targets, options, settings["startup_jobs"], settings["startup_per_device"]
+    )
+    stop_event.wait()
 
+    for server in servers:
+        server.stop()
+    MEMORY.stop()
+    scheduler.stop()
+    supervisor.stop()
+    WORKERS.stop()
+
+    flush_state()
     release_lock()
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="ramifier")
+    parser.add_argument("--version", action="version", version=__version__)
+    parser.add_argument("--json", action="store_true", help="print raw JSON results")
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser("run", help="run the daemon (default)")
+    commands.add_parser("status", help="show target status")
+    commands.add_parser("reload", help="reload the configuration")
+
+    backup = commands.add_parser("backup", help="back up a target now")
+    backup.add_argument("target")
+
+    add = commands.add_parser("add", help="add a target to the configuration")
+    add.add_argument("name")
+    add.add_argument("path")
+    add.add_argument("--backup-path")
+    add.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="target option, the value is parsed as YAML",
+    )
+
+    remove = commands.add_parser(
+        "remove", help="remove a target from the configuration"
+    )
+    remove.add_argument("name")
+
+    history = commands.add_parser(
+        "history", help="list backups, or the versions of a path"
+    )
+    history.add_argument("target")
+    history.add_argument("path", nargs="?")
+
+    extract = commands.add_parser(
+        "extract", help="extract a file or directory from a backup"
+    )
+    extract.add_argument("target")
+    extract.add_argument("path")
+    extract.add_argument(
+        "--at", help="backup file name or timestamp, defaults to the latest"
+    )
+    extract.add_argument("--dest", default=".", help="destination directory")
+    extract.add_argument(
+        "--force", action="store_true", help="overwrite existing files"
+    )
+
+    return parser.parse_args()
+
+
+def _command_args(args: argparse.Namespace) -> list:
+    if args.command == "backup":
+        return [args.target]
+    if args.command == "remove":
+        return [args.name]
+    if args.command == "add":
+        entry = {"name": args.name, "path": args.path}
+        if args.backup_path:
+            entry["backup_path"] = args.backup_path
+        for option in args.set:
+            key, _, value = option.partition("=")
+            entry[key] = yaml.safe_load(value)
+        return [entry]
+    return []
+
+
+def _catalog_command(args: argparse.Namespace):
+    try:
+        if not catalog_exists(args.target):
+            raise FileNotFoundError(f"No catalog for target {args.target}")
+        catalog = get_catalog(args.target)
+        if args.command == "extract":
+            result = _extract(catalog, args)
+        elif args.path:
+            result = catalog.history(args.path)
+        else:
+            result = catalog.backups()
+    except (ValueError, OSError, tarfile.TarError, zstd.ZstdError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(result, indent=4))
+    elif args.command == "extract":
+        print(f"Extracted {len(result)} paths to {args.dest}")
+    else:
+        _print_history(result)
+
+
+def _extract(catalog, args: argparse.Namespace) -> list:
+    backup_file = catalog.find_backup(args.at)
+    entries = catalog.resolve(backup_file, args.path)
+    if not entries:
+        raise FileNotFoundError(f"{args.path} not found in {Path(backup_file).name}")
+
+    dest = Path(args.dest)
+    if not args.force:
+        for entry in entries:
+            path = dest / entry["path"]
+            if entry["type"] != "dir" and os.path.lexists(path):
+                raise FileExistsError(f"{path} exists, use --force to overwrite")
+    dest.mkdir(parents=True, exist_ok=True)
+    extract_entries(entries, dest)
+    return [entry["path"] for entry in entries]
+
+
+def _print_history(rows: list):
+    for row in rows:
+        created = datetime.fromtimestamp(row["created"]).strftime("%Y-%m-%d %H:%M:%S")
+        name = Path(row["file"]).name
+        if "entries" in row:
+            print(
+                f"{created}  {row['kind']:<11}  {row['entries']} entries, "
+                f"{row['size'] >> 20} MiB  {name}"
+            )
+        elif row["type"] == "deleted":
+            print(f"{created}  deleted {row['path']}  {name}")
+        else:
+            mtime = datetime.fromtimestamp(row["mtime"] / 1e9).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+            print(
+                f"{created}  {row['type']:<7} {row['size']} bytes, "
+                f"modified {mtime}, sha256 {(row['hash'] or '-')[:12]}  {name}"
+            )
+
+
+def _print_status(targets: list):
+    for target in targets:
+        if target["running"]:
+            state = "running"
+        elif target["deferred"]:
+            state = "deferred"
+        else:
+            state = "stopped"
+        next_backup = (
+            f"{target['next_backup'] / 60:.1f} min"
+            if target["next_backup"] is not None
+            else "-"
+        )
+        print(
+            f"{target['name']}: {state}, {target['path']}\n"
+            f"  RAM: {target['ram_bytes'] >> 20} MiB, "
+            f"at risk: {target['at_risk_files']} files "
+            f"({target['at_risk_bytes'] >> 20} MiB)\n"
+            f"  Backups: {target['backups']} "
+            f"({target['backup_size_bytes'] >> 20} MiB), "
+            f"last: {target['last_backup'] or '-'}, next in {next_backup}"
+        )
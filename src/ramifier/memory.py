@@ -0,0 +1,176 @@
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+
+from psutil import disk_usage, virtual_memory
+
+from .changes import get_detector
+from .log import log_info, log_warning
+from .metrics import METRICS
+from .scheduler import Scheduler
+from .target import Target
+
+PSI_FILE = Path("/proc/pressure/memory")
+
+
+class MemoryManager:
+    def __init__(self):
+        self.ram_dir = None
+        self.ram_budget = 0
+        self.min_available = 0
+        self.psi_threshold = 0.0
+        self.check_interval = 10
+        self.retry = 300
+        self.demote = False
+        self.gauges = {}
+
+        self._daemons = []
+        self._scheduler = None
+        self._job = None
+        self._lock = Lock()
+        self._reserved = {}
+        self._under_pressure = False
+        self._demoted = None
+
+    def configure(self, settings: dict, ram_dir: Path):
+        self.ram_dir = ram_dir
+        self.ram_budget = (
+            settings["ram_budget"] * 1024 * 1024 or virtual_memory().total // 2
+        )
+        self.min_available = settings["min_available"] * 1024 * 1024
+        self.psi_threshold = settings["psi_threshold"]
+        self.check_interval = settings["check_interval"]
+        self.retry = settings["retry"]
+        self.demote = settings["demote"]
+
+    def start(self, scheduler: Scheduler, daemons: list):
+        self._scheduler = scheduler
+        self._daemons = daemons
+        self._schedule_check()
+
+    def stop(self):
+        if self._job is not None:
+            self._scheduler.cancel(self._job)
+
+    def admit(self, target: Target, size: int) -> bool:
+        if target.snapshot:
+            size *= 2
+        with self._lock:
+            used = sum(
+                (
+                    self.usage(daemon.target)
+                    if daemon.running
+                    else self._reserved.get(daemon.target.name, 0)
+                )
+                for daemon in self._daemons
+                if daemon.target.name != target.name
+            )
+            needed = used + size
+            if needed > self.ram_budget:
+                reason = (
+                    f"RAM budget exceeded ({needed >> 20}/{self.ram_budget >> 20} MiB)"
+                )
+            elif self.ram_dir is not None and size > disk_usage(self.ram_dir).free:
+                reason = f"not enough space in {self.ram_dir}"
+            elif virtual_memory().available - size < self.min_available:
+                reason = "not enough available memory"
+            else:
+                self._reserved[target.name] = size
+                return True
+
+        log_warning(f"Ramification deferred: {reason}", target.name)
+        return False
+
+    def release(self, target: Target):
+        with self._lock:
+            self._reserved.pop(target.name, None)
+
+    def usage(self, target: Target) -> int:
+        size = get_detector(target).cached_size()
+        return size * 2 if target.snapshot else size
+
+    def _schedule_check(self):
+        self._job = self._scheduler.schedule(
+            self.check_interval, self._check, 100, "memory"
+        )
+
+    def _check(self):
+        try:
+            self.update_gauges()
+            reason = self._pressure()
+            if reason is None:
+                if self._under_pressure:
+                    log_info("Memory pressure relieved")
+                self._under_pressure = False
+            else:
+                self._relieve(reason)
+        finally:
+            self._schedule_check()
+
+    def update_gauges(self):
+        targets = {
+            daemon.target.name: self.usage(daemon.target) if daemon.running else 0
+            for daemon in self._daemons
+        }
+        self.gauges = {
+            "ram_bytes": sum(targets.values()),
+            "ram_budget_bytes": self.ram_budget,
+            "available_bytes": virtual_memory().available,
+            "psi_some_avg10": _read_psi(),
+            "targets": targets,
+        }
+        for name, value in self.gauges.items():
+            if name != "targets":
+                METRICS.set(name, value)
+        for name, value in targets.items():
+            METRICS.set("target_ram_bytes", value, name)
+
+    def _pressure(self) -> str:
+        psi = self.gauges["psi_some_avg10"]
+        if self.psi_threshold and psi >= self.psi_threshold:
+            return f"PSI some avg10={psi:.1f}"
+        if self.gauges["available_bytes"] < self.min_available:
+            return f"{self.gauges['available_bytes'] >> 20} MiB available"
+        if self.gauges["ram_bytes"] > self.ram_budget:
+            return (
+                f"{self.gauges['ram_bytes'] >> 20}/{self.ram_budget >> 20} MiB in RAM"
+            )
+        return None
+
+    def _relieve(self, reason: str):
+        running = [daemon for daemon in self._daemons if daemon.running]
+        if not self._under_pressure:
+            log_warning(f"Memory pressure: {reason}, starting emergency backups")
+            for daemon in running:
+                daemon.backup_now()
+        self._under_pressure = True
+
+        if (
+            self.demote
+            and running
+            and (self._demoted is None or monotonic() - self._demoted >= self.retry)
+        ):
+            coldest = min(
+                running,
+                key=lambda d: (
+                    get_detector(d.target).accesses(),
+                    -self.gauges["targets"].get(d.target.name, 0),
+                ),
+            )
+            log_warning(f"Memory pressure: {reason}, demoting", coldest.target.name)
+            coldest.demote()
+            self._demoted = monotonic()
+
+
+def _read_psi() -> float:
+    try:
+        for line in PSI_FILE.read_text().splitlines():
+            if line.startswith("some "):
+                fields = dict(field.split("=") for field in line.split()[1:])
+                return float(fields["avg10"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return 0.0
+
+
+MEMORY = MemoryManager()
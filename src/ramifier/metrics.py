@@ -0,0 +1,145 @@
+import os
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Lock, Thread
+from time import monotonic
+
+from .log import log_info, log_warning
+
+PREFIX = "ramifier_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = {}
+        self._timers = {}
+        self._gauges = {}
+        self._collectors = []
+
+    def inc(self, name: str, target: str = None, value: float = 1):
+        with self._lock:
+            key = (name, target)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, target: str = None):
+        with self._lock:
+            self._gauges[(name, target)] = value
+
+    def observe(self, name: str, seconds: float, target: str = None):
+        with self._lock:
+            timer = self._timers.setdefault((name, target), [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name: str, target: str = None):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - started, target)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                log_warning(f"Metrics collector failed: {e}")
+
+        lines = []
+        with self._lock:
+            _render_group(lines, self._counters, "counter", "_total")
+            _render_group(lines, self._gauges, "gauge", "")
+            timers = {}
+            for (name, target), (count, total) in self._timers.items():
+                timers.setdefault(name, []).append((target, count, total))
+            for name in sorted(timers):
+                metric = f"{PREFIX}{name}_seconds"
+                lines.append(f"# TYPE {metric} summary")
+                for target, count, total in timers[name]:
+                    labels = _labels(target)
+                    lines.append(f"{metric}_count{labels} {count}")
+                    lines.append(f"{metric}_sum{labels} {total:.6f}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    def __init__(self, listen: str):
+        self.listen = listen
+        self._server = None
+        self._socket_path = None
+
+    def start(self):
+        if self.listen.startswith("/"):
+            self._socket_path = Path(self.listen)
+            self._socket_path.unlink(missing_ok=True)
+            self._server = _UnixHTTPServer(str(self._socket_path), _Handler)
+            os.chmod(self._socket_path, 0o600)
+        else:
+            host, _, port = self.listen.rpartition(":")
+            self._server = ThreadingHTTPServer(
+                (host or "127.0.0.1", int(port)), _Handler
+            )
+        self._server.daemon_threads = True
+
+        Thread(
+            target=self._server.serve_forever, name="ramifier-metrics", daemon=True
+        ).start()
+        log_info(f"Metrics available at {self.listen}")
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        if self._socket_path is not None:
+            self._socket_path.unlink(missing_ok=True)
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _render_group(lines: list, values: dict, kind: str, suffix: str):
+    grouped = {}
+    for (name, target), value in values.items():
+        grouped.setdefault(name, []).append((target, value))
+    for name in sorted(grouped):
+        metric = f"{PREFIX}{name}{suffix}"
+        lines.append(f"# TYPE {metric} {kind}")
+        for target, value in grouped[name]:
+            lines.append(f"{metric}{_labels(target)} {value}")
+
+
+def _labels(target: str) -> str:
+    if target is None:
+        return ""
+    escaped = target.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{{target="{escaped}"}}'
+
+
+METRICS = Metrics()
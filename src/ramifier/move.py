@@ -0,0 +1,271 @@
+import errno
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+
+from .filters import PathFilter
+from .log import log_info
+
+PROGRESS_INTERVAL = 5
+COPY_CHUNK = 1 << 30
+
+
+class Progress:
+    def __init__(self, total: int, name: str):
+        self.total = total
+        self.name = name
+        self.done = 0
+        self.started = monotonic()
+
+        self._lock = Lock()
+        self._logged = self.started
+
+    def update(self, size: int):
+        with self._lock:
+            self.done += size
+            now = monotonic()
+            if now - self._logged < PROGRESS_INTERVAL:
+                return
+            self._logged = now
+
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed else 0
+        eta = (self.total - self.done) / rate if rate else 0
+        percent = self.done * 100 // self.total if self.total else 100
+        log_info(
+            f"Copying: {self.done >> 20}/{self.total >> 20} MiB ({percent}%), "
+            f"ETA {eta:.0f}s",
+            self.name,
+        )
+
+
+def same_device(path: Path, other: Path) -> bool:
+    return os.stat(path).st_dev == os.stat(other).st_dev
+
+
+def copy_tree(
+    src: Path, dst: Path, workers: int, name: str, path_filter: PathFilter = None
+) -> int:
+    if dst.exists():
+        shutil.rmtree(dst)
+
+    dirs, files, links = _scan(src, path_filter)
+    progress = Progress(sum(file_stat.st_size for _, file_stat in files), name)
+    try:
+        for rel, _ in dirs:
+            os.mkdir(_join(dst, rel), 0o700)
+
+        _copy_files(src, dst, [rel for rel, _ in files], workers, progress)
+
+        _copy_links(src, dst, links)
+
+        _apply_dir_metadata(dst, dirs)
+
+    except BaseException:
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
+
+    elapsed = monotonic() - progress.started
+    log_info(
+        f"Copied {len(files)} files ({progress.total >> 20} MiB) in {elapsed:.1f}s",
+        name,
+    )
+    return progress.total
+
+
+def sync_tree(
+    src: Path, dst: Path, workers: int, name: str, path_filter: PathFilter = None
+) -> int:
+    dirs, files, links = _scan(src, path_filter)
+    old_dirs, old_files, old_links = _scan(dst)
+    new_dirs = dict(dirs)
+    new_files = dict(files)
+    new_links = dict(links)
+    old_links = dict(old_links)
+
+    removed = 0
+    for rel, link in old_links.items():
+        if new_links.get(rel) != link:
+            os.unlink(_join(dst, rel))
+            removed += 1
+    for rel, file_stat in old_files:
+        if rel not in new_files or _differs(new_files[rel], file_stat):
+            os.unlink(_join(dst, rel))
+            removed += rel not in new_files
+    for rel, _ in reversed(old_dirs):
+        if rel not in new_dirs:
+            shutil.rmtree(_join(dst, rel), ignore_errors=True)
+            removed += 1
+
+    old_dirs = dict(old_dirs)
+    for rel, _ in dirs:
+        if rel not in old_dirs:
+            os.mkdir(_join(dst, rel), 0o700)
+
+    old_files = dict(old_files)
+    changed = [
+        rel
+        for rel, file_stat in files
+        if rel not in old_files or _differs(file_stat, old_files[rel])
+    ]
+    progress = Progress(sum(new_files[rel].st_size for rel in changed), name)
+    _copy_files(src, dst, changed, workers, progress)
+
+    _copy_links(
+        src, dst, [(rel, link) for rel, link in links if old_links.get(rel) != link]
+    )
+
+    _apply_dir_metadata(dst, dirs)
+
+    elapsed = monotonic() - progress.started
+    log_info(
+        f"Synced {len(changed)} changed files ({progress.total >> 20} MiB), "
+        f"removed {removed} in {elapsed:.1f}s",
+        name,
+    )
+    return progress.total
+
+
+def prune_tree(root: Path, path_filter: PathFilter) -> int:
+    removed = 0
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(_join(root, rel_dir)) as entries:
+            for entry in entries:
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if path_filter.match(rel, is_dir):
+                    if is_dir:
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.unlink(entry.path)
+                    removed += 1
+                elif is_dir:
+                    stack.append(rel)
+    return removed
+
+
+def copy_file(src: str, dst: str) -> int:
+    fd_in = os.open(src, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        src_stat = os.fstat(fd_in)
+        fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            _copy_data(fd_in, fd_out, src_stat.st_size)
+            _copy_xattrs(fd_in, fd_out)
+            os.fchmod(fd_out, stat.S_IMODE(src_stat.st_mode))
+            os.utime(fd_out, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+    return src_stat.st_size
+
+
+def _copy_files(src: Path, dst: Path, files: list, workers: int, progress: Progress):
+    with ThreadPoolExecutor(max_workers=workers or None) as pool:
+        for size in pool.map(
+            lambda rel: copy_file(_join(src, rel), _join(dst, rel)), files
+        ):
+            progress.update(size)
+
+
+def _copy_links(src: Path, dst: Path, links: list):
+    for rel, link in links:
+        path = _join(dst, rel)
+        os.symlink(link, path)
+        link_stat = os.lstat(_join(src, rel))
+        os.utime(
+            path,
+            ns=(link_stat.st_atime_ns, link_stat.st_mtime_ns),
+            follow_symlinks=False,
+        )
+
+
+def _apply_dir_metadata(root: Path, dirs: list):
+    for rel, dir_stat in reversed(dirs):
+        path = _join(root, rel)
+        os.chmod(path, stat.S_IMODE(dir_stat.st_mode))
+        os.utime(path, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+
+
+def _differs(new_stat: os.stat_result, old_stat: os.stat_result) -> bool:
+    return (new_stat.st_size, new_stat.st_mtime_ns, new_stat.st_mode) != (
+        old_stat.st_size,
+        old_stat.st_mtime_ns,
+        old_stat.st_mode,
+    )
+
+
+def _scan(root: Path, path_filter: PathFilter = None) -> tuple[list, list, list]:
+    dirs = [("", os.stat(root))]
+    files = []
+    links = []
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(_join(root, rel_dir)) as entries:
+            for entry in entries:
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if path_filter is not None and path_filter.match(
+                    rel, entry.is_dir(follow_symlinks=False)
+                ):
+                    continue
+                if entry.is_symlink():
+                    links.append((rel, os.readlink(entry.path)))
+                elif entry.is_dir(follow_symlinks=False):
+                    dirs.append((rel, entry.stat(follow_symlinks=False)))
+                    stack.append(rel)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append((rel, entry.stat(follow_symlinks=False)))
+    return dirs, files, links
+
+
+def _copy_xattrs(fd_in: int, fd_out: int):
+    try:
+        names = os.listxattr(fd_in)
+    except OSError as e:
+        if e.errno in (errno.ENOTSUP, errno.ENODATA):
+            return
+        raise
+
+    for name in names:
+        try:
+            os.setxattr(fd_out, name, os.getxattr(fd_in, name))
+        except OSError as e:
+            if e.errno not in (errno.ENOTSUP, errno.ENODATA, errno.EPERM):
+                raise
+
+
+def _copy_data(fd_in: int, fd_out: int, size: int):
+    offset = 0
+    try:
+        while offset < size:
+            copied = os.copy_file_range(fd_in, fd_out, min(size - offset, COPY_CHUNK))
+            if copied == 0:
+                return
+            offset += copied
+        return
+    except (AttributeError, OSError) as e:
+        if isinstance(e, OSError) and e.errno not in (
+            errno.EXDEV,
+            errno.ENOSYS,
+            errno.EINVAL,
+            errno.EOPNOTSUPP,
+        ):
+            raise
+
+    while offset < size:
+        copied = os.sendfile(fd_out, fd_in, offset, min(size - offset, COPY_CHUNK))
+        if copied == 0:
+            return
+        offset += copied
+
+
+def _join(root: Path, rel: str) -> str:
+    return os.path.join(root, rel) if rel else str(root)
@@ -0,0 +1,148 @@
+import os
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from time import monotonic
+
+from .global_settings import GlobalSettings
+from .log import log_error, log_info, log_warning
+from .target import Target
+from .utils import is_tmpfs
+
+
+def build_targets(global_settings: GlobalSettings, options: dict) -> list:
+    started = monotonic()
+    if not is_tmpfs(global_settings.ram_dir):
+        log_warning(f"RAM directory is not on tmpfs: {global_settings.ram_dir}")
+
+    targets = []
+    errors = []
+    for name, target_options in options.items():
+        try:
+            targets.append(Target(**target_options))
+        except (ValueError, TypeError, OSError) as e:
+            errors.append(f"{name}: {e}")
+    errors.extend(check_targets(targets, global_settings.ram_dir))
+
+    if errors:
+        raise ValueError(f"Invalid configuration: {'; '.join(errors)}")
+    log_info(
+        f"Validated {len(targets)} targets in {(monotonic() - started) * 1000:.0f}ms"
+    )
+    return targets
+
+
+def check_targets(targets: list, ram_dir: Path) -> list:
+    errors = []
+    paths = {}
+    ram_dir = _absolute(ram_dir)
+    for target in targets:
+        path = _absolute(target.path)
+        if path in paths:
+            errors.append(f"{target.name}: same path as {paths[path]}")
+        paths[path] = target.name
+        if path == ram_dir or _is_within(path, ram_dir):
+            errors.append(f"{target.name}: path is inside the RAM directory")
+
+    for target in targets:
+        backup_path = _absolute(target.backup_path)
+        for path, name in paths.items():
+            if backup_path == path or _is_within(backup_path, path):
+                errors.append(f"{target.name}: backup path is inside target {name}")
+    return errors
+
+
+def start_daemons(daemons: list, max_jobs: int, per_device: int):
+    started = monotonic()
+    parents = _parents(daemons)
+    _run_ordered(
+        daemons, parents, lambda daemon: daemon.start_now(), max_jobs, per_device
+    )
+
+    running = [daemon for daemon in daemons if daemon.running]
+    if running:
+        slowest = max(running, key=lambda daemon: daemon.timings["total"])
+        log_info(
+            f"Started {len(running)}/{len(daemons)} targets in "
+            f"{monotonic() - started:.1f}s, slowest: {slowest.target.name} "
+            f"({slowest.timings['total']:.1f}s)"
+        )
+
+
+def stop_daemons(daemons: list, max_jobs: int):
+    parents = _parents(daemons)
+    children = {
+        daemon: {other for other in daemons if daemon in parents[other]}
+        for daemon in daemons
+    }
+    _run_ordered(daemons, children, lambda daemon: daemon.stop(), max_jobs, 0)
+
+
+def _run_ordered(daemons: list, blockers: dict, fn, max_jobs: int, per_device: int):
+    max_jobs = max_jobs or len(daemons) or 1
+    ranks = _ranks(daemons, blockers)
+    devices = {daemon: _device(daemon.target) for daemon in daemons}
+    pending = sorted(daemons, key=lambda daemon: ranks[daemon], reverse=True)
+    done = set()
+    running = {}
+    busy = Counter()
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as pool:
+        while pending or running:
+            for daemon in list(pending):
+                if len(running) >= max_jobs:
+                    break
+                if not blockers[daemon] <= done:
+                    continue
+                if per_device and busy[devices[daemon]] >= per_device:
+                    continue
+                pending.remove(daemon)
+                busy[devices[daemon]] += 1
+                running[pool.submit(fn, daemon)] = daemon
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                daemon = running.pop(future)
+                busy[devices[daemon]] -= 1
+                done.add(daemon)
+                try:
+                    future.result()
+                except Exception as e:
+                    log_error(
+                        f"Daemon terminated due to error: {e}", daemon.target.name
+                    )
+
+
+def _parents(daemons: list) -> dict:
+    return {
+        daemon: {
+            other
+            for other in daemons
+            if other is not daemon
+            and _is_within(_absolute(daemon.target.path), _absolute(other.target.path))
+        }
+        for daemon in daemons
+    }
+
+
+def _ranks(daemons: list, blockers: dict) -> dict:
+    ranks = {daemon: daemon.target.priority for daemon in daemons}
+    for daemon in daemons:
+        for blocker in blockers[daemon]:
+            ranks[blocker] = max(ranks[blocker], daemon.target.priority)
+    return ranks
+
+
+def _device(target: Target) -> int:
+    try:
+        return os.stat(target.backup_path).st_dev
+    except OSError:
+        return 0
+
+
+def _absolute(path: Path) -> Path:
+    return Path(os.path.abspath(path))
+
+
+def _is_within(path: Path, parent: Path) -> bool:
+    return path != parent and parent in path.parents
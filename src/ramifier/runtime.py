@@ -1,30 +1,161 @@
 import os
 import shutil
 from pathlib import Path
+from time import monotonic
 
 from .log import log_info, log_warning
+from .metrics import METRICS
+from .move import copy_tree, prune_tree, same_device, sync_tree
+from .state import get_speed, mark_speed
 from .target import Target
 
+SPEED_MIN_SIZE = 1 << 20
 
-def create_symlink(target: Target):
-    if target.ram_path.exists():
-        shutil.rmtree(target.ram_path)
-        log_warning(f"Existing RAM path removed: {target.ram_path}", target.name)
 
-    shutil.move(target.path, target.ram_path)
+def create_symlink(target: Target, in_ram: bool = False):
+    with METRICS.timer("move_to_ram", target.name):
+        _create_symlink(target, in_ram)
+
+
+def remove_symlink(target: Target):
+    with METRICS.timer("move_to_disk", target.name):
+        _remove_symlink(target)
+
+
+def discard_symlink(target: Target):
+    _remove_path(target)
+    os.rename(base_path(target), target.path)
+    shutil.rmtree(target.ram_path)
+    log_info("Discarded RAM copy, on-disk copy is stale until next start", target.name)
+
+
+def recover_base(target: Target) -> bool:
+    base = base_path(target)
+    if not base.exists():
+        return False
+
+    if target.path.is_dir() and any(target.path.iterdir()):
+        shutil.rmtree(base)
+        return False
+
+    _remove_path(target)
+    os.rename(base, target.path)
+    log_warning(f"On-disk copy recovered: {target.path}", target.name)
+    return True
+
+
+def reconcile_base(target: Target):
+    if target.shutdown_mode == "copy":
+        return
+    size = sync_tree(
+        target.ram_path,
+        target.path,
+        target.move_threads,
+        target.name,
+        target.path_filter,
+    )
+    METRICS.inc("moved_bytes", target.name, size)
+
+
+def base_path(target: Target) -> Path:
+    return target.path.with_name(f".{target.path.name}.ramifier-base")
+
+
+def prefer_restore(target: Target) -> bool:
+    move_speed = get_speed(target, "move")
+    restore_speed = get_speed(target, "restore")
+    if not move_speed or not restore_speed:
+        return False
+    return restore_speed * 0.8 > move_speed
+
+
+def _create_symlink(target: Target, in_ram: bool):
+    if not in_ram:
+        if target.ram_path.exists():
+            shutil.rmtree(target.ram_path)
+            log_warning(f"Existing RAM path removed: {target.ram_path}", target.name)
+
+        if same_device(target.path, target.ram_path.parent):
+            os.rename(target.path, target.ram_path)
+            _prune(target, target.ram_path)
+        else:
+            temp_path = target.ram_path.with_name(f".{target.ram_path.name}.tmp")
+            _copy(target, target.path, temp_path)
+            os.rename(temp_path, target.ram_path)
+
+    old_path = _retire_path(target)
     os.chmod(target.ram_path, 0o700)
     target.path.symlink_to(target.ram_path, target_is_directory=True)
     log_info(f"Symlink created: {target.path} -> {target.ram_path}", target.name)
 
+    if old_path is not None:
+        shutil.rmtree(old_path)
 
-def remove_symlink(target: Target):
+
+def _remove_symlink(target: Target):
     if not target.ram_path.exists():
         raise FileNotFoundError(f"{target.ram_path} does not exist, nothing to restore")
 
+    base = base_path(target)
+    if target.shutdown_mode != "copy" and base.exists():
+        size = sync_tree(
+            target.ram_path, base, target.move_threads, target.name, target.path_filter
+        )
+        METRICS.inc("moved_bytes", target.name, size)
+        _remove_path(target)
+        os.rename(base, target.path)
+        shutil.rmtree(target.ram_path)
+    elif same_device(target.ram_path, target.path.parent):
+        _prune(target, target.ram_path)
+        _remove_path(target)
+        os.rename(target.ram_path, target.path)
+    else:
+        temp_path = target.path.with_name(f".{target.path.name}.ramifier-tmp")
+        _copy(target, target.ram_path, temp_path)
+        _remove_path(target)
+        os.rename(temp_path, target.path)
+        shutil.rmtree(target.ram_path)
+
+    log_info("Restored from RAM", target.name)
+
+
+def _copy(target: Target, src, dst):
+    started = monotonic()
+    size = copy_tree(src, dst, target.move_threads, target.name, target.path_filter)
+    METRICS.inc("moved_bytes", target.name, size)
+    if size >= SPEED_MIN_SIZE:
+        mark_speed(target, "move", size / max(monotonic() - started, 1e-3))
+
+
+def _prune(target: Target, root: Path):
+    if target.path_filter.empty():
+        return
+    removed = prune_tree(root, target.path_filter)
+    if removed:
+        log_info(f"Dropped {removed} excluded paths", target.name)
+
+
+def _retire_path(target: Target) -> Path:
+    if not target.path.exists():
+        return None
+    if not any(target.path.iterdir()):
+        target.path.rmdir()
+        return None
+
+    if target.shutdown_mode == "copy":
+        old_path = target.path.with_name(f".{target.path.name}.ramifier-old")
+        os.rename(target.path, old_path)
+        return old_path
+
+    base = base_path(target)
+    if base.exists():
+        shutil.rmtree(base)
+    os.rename(target.path, base)
+    return None
+
+
+def _remove_path(target: Target):
     if target.path.is_symlink():
         target.path.unlink()
     elif target.path.exists() and target.path.is_dir():
         shutil.rmtree(target.path)
-
-    shutil.move(target.ram_path, target.path)
-    log_info("Restored from RAM", target.name)
@@ -0,0 +1,175 @@
+import heapq
+import itertools
+import random
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
+
+from .log import log_error
+
+
+class Job:
+    def __init__(self, due: float, priority: int, fn, name: str):
+        self.due = due
+        self.priority = priority
+        self.fn = fn
+        self.name = name
+        self.cancelled = False
+
+
+class Scheduler:
+    def __init__(self, workers: int, jitter: float = 0.0):
+        self.workers = max(workers, 1)
+        self.jitter = jitter
+
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._threads = []
+        self._stopped = False
+
+    def start(self):
+        for i in range(self.workers):
+            thread = Thread(target=self._worker, name=f"ramifier-worker-{i}")
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            for _, _, _, job in self._queue:
+                job.cancelled = True
+            self._queue.clear()
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def schedule(
+        self, delay: float, fn, priority: int = 0, name: str = "ramifier"
+    ) -> Job:
+        if self.jitter and delay > 0:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        job = Job(monotonic() + delay, priority, fn, name)
+        with self._cond:
+            if self._stopped:
+                job.cancelled = True
+                return job
+            heapq.heappush(self._queue, (job.due, -priority, next(self._seq), job))
+            self._cond.notify()
+        return job
+
+    def cancel(self, job: Job):
+        with self._cond:
+            job.cancelled = True
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            try:
+                job.fn()
+            except Exception as e:
+                log_error(f"Scheduled job failed: {e}", job.name)
+
+    def _next_job(self) -> Job:
+        with self._cond:
+            while not self._stopped:
+                while self._queue and self._queue[0][3].cancelled:
+                    heapq.heappop(self._queue)
+
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+
+                now = monotonic()
+                if self._queue[0][0] > now:
+                    self._cond.wait(self._queue[0][0] - now)
+                    continue
+
+                due = []
+                while self._queue and self._queue[0][0] <= now:
+                    due.append(heapq.heappop(self._queue))
+                due.sort(key=lambda item: (item[1], item[0], item[2]))
+                for item in due[1:]:
+                    heapq.heappush(self._queue, item)
+                if due[0][3].cancelled:
+                    continue
+                return due[0][3]
+            return None
+
+
+class PriorityGate:
+    def __init__(self, slots: int):
+        self.slots = max(slots, 1)
+
+        self._active = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = Condition()
+
+    @contextmanager
+    def acquire(self, priority: int = 0):
+        entry = (-priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            while self._waiting[0] != entry or self._active >= self.slots:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._active += 1
+            self._cond.notify_all()
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+
+class Limits:
+    def __init__(self):
+        self._compressions = None
+        self._io_limit = 0
+        self._io_lock = Lock()
+        self._io_allowance = 0.0
+        self._io_time = monotonic()
+
+    def configure(self, max_compressions: int, io_limit: int):
+        self._compressions = (
+            PriorityGate(max_compressions) if max_compressions > 0 else None
+        )
+        self._io_limit = io_limit
+
+    @contextmanager
+    def compression(self, priority: int = 0):
+        if self._compressions is None:
+            yield
+            return
+
+        with self._compressions.acquire(priority):
+            yield
+
+    def throttle(self, size: int):
+        if self._io_limit <= 0:
+            return
+
+        with self._io_lock:
+            now = monotonic()
+            self._io_allowance = min(
+                self._io_allowance + (now - self._io_time) * self._io_limit,
+                self._io_limit,
+            )
+            self._io_time = now
+            self._io_allowance -= size
+            delay = -self._io_allowance / self._io_limit
+
+        if delay > 0:
+            sleep(delay)
+
+
+LIMITS = Limits()
@@ -0,0 +1,133 @@
+import os
+import shutil
+import stat
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+
+from .log import log_info, log_warning
+from .move import copy_file, copy_tree
+from .target import Target
+
+STAGE_RETRIES = 3
+
+_SNAPSHOTS = {}
+_SNAPSHOTS_LOCK = Lock()
+
+
+class Snapshot:
+    def __init__(self, target: Target):
+        self.target = target
+        self.path = target.ram_path.with_name(f".{target.ram_path.name}.snapshot")
+
+        self._dirs = None
+
+    def stage(self, dirty: dict, files: dict, dirs: set) -> Path:
+        started = monotonic()
+        root = self.target.data_path.resolve()
+        if self._dirs is None:
+            copy_tree(
+                root,
+                self.path,
+                self.target.move_threads,
+                self.target.name,
+                self.target.path_filter,
+            )
+            self._dirs = set(dirs)
+            log_info(
+                f"Snapshot created in {monotonic() - started:.1f}s", self.target.name
+            )
+            return self.path
+
+        for rel in dirty:
+            if rel not in files and rel not in dirs:
+                _remove(self.path / rel)
+        self._sync_dirs(root, dirs, dirty)
+
+        torn = [
+            rel for rel in dirty if rel in files and not self._stage_file(root, rel)
+        ]
+        if torn:
+            log_warning(
+                f"Files kept changing while staging: {', '.join(torn[:5])}",
+                self.target.name,
+            )
+        log_info(
+            f"Snapshot staged: {len(dirty)} paths in "
+            f"{(monotonic() - started) * 1000:.0f}ms",
+            self.target.name,
+        )
+        return self.path
+
+    def drop(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._dirs = None
+
+    def _sync_dirs(self, root: Path, dirs: set, dirty: dict):
+        for rel in sorted(self._dirs - dirs, reverse=True):
+            if rel:
+                _remove(self.path / rel)
+        for rel in sorted((dirs - self._dirs) | (dirs & dirty.keys())):
+            dst = self.path / rel
+            if dst.is_symlink() or dst.exists() and not dst.is_dir():
+                dst.unlink()
+            dst.mkdir(parents=True, exist_ok=True)
+            try:
+                shutil.copystat(root / rel, dst)
+            except OSError:
+                continue
+        self._dirs = set(dirs)
+
+    def _stage_file(self, root: Path, rel: str) -> bool:
+        src = root / rel
+        dst = self.path / rel
+        temp_file = dst.with_name(f".{dst.name}.ramifier-stage")
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        for _ in range(STAGE_RETRIES):
+            try:
+                before = os.lstat(src)
+                temp_file.unlink(missing_ok=True)
+                if stat.S_ISLNK(before.st_mode):
+                    os.symlink(os.readlink(src), temp_file)
+                elif stat.S_ISREG(before.st_mode):
+                    copy_file(str(src), str(temp_file))
+                else:
+                    os.mknod(temp_file, before.st_mode, before.st_rdev)
+                after = os.lstat(src)
+            except FileNotFoundError:
+                temp_file.unlink(missing_ok=True)
+                _remove(dst)
+                return True
+
+            if dst.is_dir() and not dst.is_symlink():
+                shutil.rmtree(dst)
+            os.replace(temp_file, dst)
+            if (before.st_size, before.st_mtime_ns) == (
+                after.st_size,
+                after.st_mtime_ns,
+            ):
+                return True
+        return False
+
+
+def get_snapshot(target: Target) -> Snapshot:
+    with _SNAPSHOTS_LOCK:
+        snapshot = _SNAPSHOTS.get(target.name)
+        if snapshot is None:
+            snapshot = Snapshot(target)
+            _SNAPSHOTS[target.name] = snapshot
+        return snapshot
+
+
+def drop_snapshot(target: Target):
+    with _SNAPSHOTS_LOCK:
+        snapshot = _SNAPSHOTS.pop(target.name, None)
+    if snapshot is not None:
+        snapshot.drop()
+
+
+def _remove(path: Path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
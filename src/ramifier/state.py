@@ -2,20 +2,29 @@ import json
 import os
 from collections import deque
 from pathlib import Path
-from threading import Lock
+from threading import Lock, Timer
 
 from xdg import BaseDirectory
 
 from .log import log_info
+from .metrics import METRICS
 from .target import Target
 from .utils import ensure_dir
 
 STATE_PATH = Path(BaseDirectory.xdg_state_home) / "ramifier"
 STATE_FILE = STATE_PATH / "state.json"
 STATE_TEMP_FILE = STATE_FILE.with_suffix(".tmp")
+JOURNAL_FILE = STATE_PATH / "state.journal"
 STATE_LOCK = Lock()
 
-STATE = {"targets": {}}
+FLUSH_DELAY = 5
+JOURNAL_LIMIT = 512
+
+STATE = {"targets": {}, "journal_seq": 0}
+
+_PENDING = []
+_JOURNAL_SIZE = 0
+_FLUSH_TIMER = None
 
 
 def load_state():
@@ -24,80 +33,282 @@ def load_state():
             loaded_state = json.load(f_in)
 
         STATE.update(loaded_state)
-    else:
-        _save_state()
+
+    with STATE_LOCK:
+        _replay_journal()
+        _compact()
+
+
+def flush_state():
+    with STATE_LOCK:
+        _flush()
+        _compact()
 
 
 def mark_start(target: Target):
-    STATE["targets"].setdefault(
-        target.name,
-        {
-            "backups": [],
-            "hash_history": deque(),
-            "running": True,
-        },
-    )
-    _save_state()
+    _commit("start", target.name, sync=True)
 
 
 def mark_running(target: Target):
-    STATE["targets"].setdefault(target.name, {})["running"] = True
-    _save_state()
+    _commit("running", target.name, True, sync=True)
 
 
-def mark_backup(target: Target, backup_file: Path, backup_hash: str):
-    STATE["targets"].setdefault(target.name, {}).setdefault("backups", []).append(
-        {"file": str(backup_file), "hash": backup_hash}
-    )
-    _save_state()
+def mark_backup(
+    target: Target,
+    backup_file: Path,
+    backup_hash: str,
+    kind: str = "full",
+    parent: Path = None,
+    index_hash: str = None,
+    dict_id: int = None,
+):
+    backup = {"file": str(backup_file), "hash": backup_hash, "kind": kind}
+    if parent is not None:
+        backup["parent"] = str(parent)
+    if index_hash is not None:
+        backup["index_hash"] = index_hash
+    if dict_id is not None:
+        backup["dict_id"] = dict_id
+
+    _commit("backup", target.name, backup, sync=True)
 
 
 def mark_hash(target: Target, hash: str):
-    STATE["targets"].setdefault(target.name, {}).setdefault(
-        "hash_history", deque()
-    ).append(hash)
-    _save_state()
+    _commit("hash", target.name, hash)
+
+
+def mark_hot_files(target: Target, hot_files: list):
+    if STATE["targets"].get(target.name, {}).get("hot_files") != hot_files:
+        _commit("hot_files", target.name, hot_files)
+
+
+def mark_stopped(target: Target):
+    _commit("running", target.name, False, sync=True)
 
 
 def mark_clean_exit(target: Target):
-    STATE["targets"].setdefault(target.name, {})["running"] = False
+    _commit("running", target.name, False, sync=True)
     log_info("Exited cleanly", target.name)
-    _save_state()
+
+
+def mark_stale(target: Target, stale: bool):
+    _commit("stale", target.name, stale, sync=True)
+
+
+def mark_compression_stats(target: Target, stats: dict):
+    _commit("compression", target.name, stats)
+
+
+def mark_dictionary(target: Target, dict_id: int):
+    _commit("dictionary", target.name, dict_id)
+
+
+def mark_speed(target: Target, kind: str, speed: float):
+    _commit("speed", target.name, {"kind": kind, "speed": speed})
 
 
 def set_hash_history_len(target: Target, hash_history_len: int):
-    hash_history = get_hash_history(target)
-    STATE["targets"][target.name]["hash_history"] = deque(
-        hash_history, hash_history_len
-    )
-    _save_state()
+    _commit("hash_history_len", target.name, hash_history_len)
 
 
 def remove_backup(target: Target, backup: dict):
-    STATE["targets"][target.name]["backups"].remove(backup)
-    _save_state()
+    _commit("remove_backup", target.name, backup)
 
 
 def get_backups(target: Target) -> list:
     return STATE["targets"].get(target.name, {}).get("backups", [])
 
 
+def get_backup_chain(target: Target, backup: dict) -> list:
+    backups = {b.get("file"): b for b in get_backups(target)}
+    chain = [backup]
+    while chain[0].get("kind") == "incremental":
+        parent = backups.get(chain[0].get("parent"))
+        if parent is None or parent in chain:
+            return []
+        chain.insert(0, parent)
+    return chain
+
+
 def get_hash_history(target: Target) -> deque[str]:
     return STATE["targets"].get(target.name, {}).get("hash_history", deque())
 
 
+def get_hot_files(target: Target) -> list:
+    return STATE["targets"].get(target.name, {}).get("hot_files", [])
+
+
+def get_compression_stats(target: Target) -> dict:
+    return STATE["targets"].get(target.name, {}).get("compression", {})
+
+
+def get_dictionary_id(target: Target) -> int:
+    return STATE["targets"].get(target.name, {}).get("dictionary")
+
+
+def get_speed(target: Target, kind: str) -> float:
+    return STATE["targets"].get(target.name, {}).get("speeds", {}).get(kind)
+
+
+def get_stale(target: Target) -> bool:
+    return STATE["targets"].get(target.name, {}).get("stale", False)
+
+
 def get_running(target: Target) -> bool:
     return STATE["targets"].get(target.name, {}).get("running", False)
 
 
-def _save_state():
-    ensure_dir(STATE_PATH)
+def _apply_start(target_state: dict, _):
+    target_state.setdefault("backups", [])
+    target_state.setdefault("hash_history", deque())
+    target_state.setdefault("running", True)
+
+
+def _apply_running(target_state: dict, running: bool):
+    target_state["running"] = running
+
+
+def _apply_stale(target_state: dict, stale: bool):
+    target_state["stale"] = stale
+
+
+def _apply_backup(target_state: dict, backup: dict):
+    target_state.setdefault("backups", []).append(backup)
+
+
+def _apply_hash(target_state: dict, hash: str):
+    target_state.setdefault("hash_history", deque()).append(hash)
+
+
+def _apply_hot_files(target_state: dict, hot_files: list):
+    target_state["hot_files"] = hot_files
+
+
+def _apply_compression(target_state: dict, stats: dict):
+    target_state["compression"] = stats
+
+
+def _apply_dictionary(target_state: dict, dict_id: int):
+    target_state["dictionary"] = dict_id
+
+
+def _apply_speed(target_state: dict, value: dict):
+    speeds = target_state.setdefault("speeds", {})
+    previous = speeds.get(value["kind"])
+    speeds[value["kind"]] = (
+        value["speed"] if previous is None else (previous + value["speed"]) / 2
+    )
+
+
+def _apply_hash_history_len(target_state: dict, hash_history_len: int):
+    target_state["hash_history"] = deque(
+        target_state.get("hash_history", ()), hash_history_len
+    )
+
+
+def _apply_remove_backup(target_state: dict, backup: dict):
+    if backup in target_state.get("backups", []):
+        target_state["backups"].remove(backup)
+
+
+_OPS = {
+    "start": _apply_start,
+    "running": _apply_running,
+    "stale": _apply_stale,
+    "backup": _apply_backup,
+    "hash": _apply_hash,
+    "hot_files": _apply_hot_files,
+    "compression": _apply_compression,
+    "dictionary": _apply_dictionary,
+    "speed": _apply_speed,
+    "hash_history_len": _apply_hash_history_len,
+    "remove_backup": _apply_remove_backup,
+}
+
+
+def _commit(op: str, name: str, value=None, sync: bool = False):
+    global _FLUSH_TIMER
+
+    with STATE_LOCK:
+        _OPS[op](STATE["targets"].setdefault(name, {}), value)
+        STATE["journal_seq"] += 1
+        _PENDING.append(
+            {"seq": STATE["journal_seq"], "op": op, "target": name, "value": value}
+        )
+
+        if sync:
+            _flush(True)
+            if _JOURNAL_SIZE >= JOURNAL_LIMIT:
+                _compact()
+        elif _FLUSH_TIMER is None:
+            _FLUSH_TIMER = Timer(FLUSH_DELAY, _flush_later)
+            _FLUSH_TIMER.daemon = True
+            _FLUSH_TIMER.start()
+
+
+def _flush_later():
+    global _FLUSH_TIMER
+
     with STATE_LOCK:
-        with STATE_TEMP_FILE.open("w") as f_out:
-            json.dump(
-                STATE,
-                f_out,
-                default=lambda o: list(o) if isinstance(o, deque) else None,
-                indent=4,
+        _FLUSH_TIMER = None
+        _flush()
+        if _JOURNAL_SIZE >= JOURNAL_LIMIT:
+            _compact()
+
+
+def _flush(sync: bool = False):
+    global _JOURNAL_SIZE
+
+    if not _PENDING:
+        return
+
+    ensure_dir(STATE_PATH)
+    with METRICS.timer("state_flush"), JOURNAL_FILE.open("a") as f_out:
+        for entry in _PENDING:
+            f_out.write(json.dumps(entry, default=_encode) + "\n")
+        f_out.flush()
+        if sync:
+            os.fsync(f_out.fileno())
+
+    _JOURNAL_SIZE += len(_PENDING)
+    _PENDING.clear()
+
+
+def _replay_journal():
+    global _JOURNAL_SIZE
+
+    if not JOURNAL_FILE.exists():
+        return
+
+    with JOURNAL_FILE.open("r") as f_in:
+        for line in f_in:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if entry["seq"] <= STATE["journal_seq"]:
+                continue
+            _OPS[entry["op"]](
+                STATE["targets"].setdefault(entry["target"], {}), entry["value"]
             )
-        os.replace(STATE_TEMP_FILE, STATE_FILE)
+            STATE["journal_seq"] = entry["seq"]
+            _JOURNAL_SIZE += 1
+
+
+def _compact():
+    global _JOURNAL_SIZE
+
+    _flush()
+    ensure_dir(STATE_PATH)
+    with METRICS.timer("state_compact"), STATE_TEMP_FILE.open("w") as f_out:
+        json.dump(STATE, f_out, default=_encode, indent=4)
+        f_out.flush()
+        os.fsync(f_out.fileno())
+    os.replace(STATE_TEMP_FILE, STATE_FILE)
+
+    JOURNAL_FILE.unlink(missing_ok=True)
+    _JOURNAL_SIZE = 0
+
+
+def _encode(o):
+    return list(o) if isinstance(o, deque) else None
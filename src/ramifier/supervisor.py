@@ -0,0 +1,164 @@
+import os
+from pathlib import Path
+from threading import Lock
+
+from .changes import drop_detector
+from .config import load_global_settings, load_target_options, read_config, write_config
+from .daemon import Daemon
+from .global_settings import GlobalSettings
+from .log import log_error, log_info, set_log_format
+from .memory import MEMORY
+from .orchestrator import check_targets, start_daemons, stop_daemons
+from .scheduler import LIMITS, Scheduler
+from .target import LIVE_OPTIONS, Target
+from .workers import WORKERS
+
+
+class Supervisor:
+    def __init__(self, scheduler: Scheduler):
+        self.scheduler = scheduler
+        self.daemons = []
+
+        self._options = {}
+        self._lock = Lock()
+
+    def start(self, targets: list, options: dict, max_jobs: int, per_device: int):
+        with self._lock:
+            daemons = [
+                self._register(target, options[target.name]) for target in targets
+            ]
+            start_daemons(daemons, max_jobs, per_device)
+
+    def stop(self):
+        with self._lock:
+            daemons = list(self.daemons)
+        stop_daemons(daemons, 0)
+
+    def status(self) -> list:
+        return [daemon.status() for daemon in list(self.daemons)]
+
+    def backup(self, name: str) -> str:
+        if not self._get(name).backup_now():
+            raise RuntimeError(f"Target {name} is not running")
+        return f"Backup of {name} scheduled"
+
+    def reload(self) -> dict:
+        with self._lock:
+            return self._reload()
+
+    def add(self, entry: dict) -> dict:
+        with self._lock:
+            path = Path(os.path.expandvars(entry.get("path") or "")).expanduser()
+            if not entry.get("path") or not path.is_dir():
+                raise NotADirectoryError(f"{path} is not a directory")
+
+            config = read_config()
+            config.setdefault("targets", []).append(entry)
+            load_target_options(load_global_settings(config), config)
+            write_config(config)
+            return self._reload()
+
+    def remove(self, name: str) -> dict:
+        with self._lock:
+            config = read_config()
+            targets = config.get("targets", [])
+            config["targets"] = [t for t in targets if t.get("name") != name]
+            if len(config["targets"]) == len(targets):
+                raise ValueError(f"Unknown target: {name}")
+
+            write_config(config)
+            return self._reload()
+
+    def _reload(self) -> dict:
+        config = read_config()
+        global_settings = load_global_settings(config)
+        options = load_target_options(global_settings, config)
+        configure(global_settings)
+
+        changes = {
+            "added": [],
+            "removed": [],
+            "updated": [],
+            "restarted": [],
+            "failed": [],
+        }
+        restart = []
+        for daemon in list(self.daemons):
+            name = daemon.target.name
+            old = self._options[name]
+            new = options.get(name)
+            if new == old:
+                continue
+
+            changed = {key for key in old if new is not None and new[key] != old[key]}
+            if new is not None and changed <= LIVE_OPTIONS:
+                daemon.update({key: new[key] for key in changed})
+                self._options[name] = new
+                changes["updated"].append(name)
+                continue
+
+            self._remove(daemon)
+            if new is None:
+                changes["removed"].append(name)
+            else:
+                restart.append(name)
+
+        for name, target_options in options.items():
+            if name in self._options:
+                continue
+            try:
+                self._add(target_options, global_settings)
+            except Exception as e:
+                log_error(f"Failed to add target: {e}", name)
+                changes["failed"].append(name)
+                continue
+            changes["restarted" if name in restart else "added"].append(name)
+
+        log_info(
+            "Configuration reloaded: "
+            + ", ".join(f"{len(names)} {kind}" for kind, names in changes.items())
+        )
+        return changes
+
+    def _add(self, options: dict, global_settings: GlobalSettings):
+        target = Target(**options)
+        errors = check_targets(
+            [daemon.target for daemon in self.daemons] + [target],
+            global_settings.ram_dir,
+        )
+        if errors:
+            raise ValueError("; ".join(errors))
+        self._register(target, options).start()
+
+    def _register(self, target: Target, options: dict) -> Daemon:
+        daemon = Daemon(target, self.scheduler)
+        self._options[target.name] = options
+        self.daemons.append(daemon)
+        log_info("Target added", target.name)
+        return daemon
+
+    def _remove(self, daemon: Daemon):
+        daemon.stop()
+        self.daemons.remove(daemon)
+        del self._options[daemon.target.name]
+        drop_detector(daemon.target)
+        log_info("Target removed", daemon.target.name)
+
+    def _get(self, name: str) -> Daemon:
+        for daemon in list(self.daemons):
+            if daemon.target.name == name:
+                return daemon
+        raise ValueError(f"Unknown target: {name}")
+
+
+def configure(global_settings: GlobalSettings):
+    set_log_format(global_settings.log_format)
+    settings = global_settings.scheduler
+    LIMITS.configure(settings["max_compressions"], settings["io_limit"] * 1024 * 1024)
+    WORKERS.configure(
+        settings["executor"],
+        settings["max_jobs"],
+        settings["io_limit"] * 1024 * 1024,
+        global_settings.log_format,
+    )
+    MEMORY.configure(global_settings.memory, global_settings.ram_dir)
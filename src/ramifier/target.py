@@ -1,11 +1,34 @@
 import os
 from pathlib import Path
+from typing import Union
 
 from xdg import BaseDirectory
 
+from .filters import PathFilter
 from .log import log_warning
 from .utils import ensure_dir
 
+LIVE_OPTIONS = {
+    "max_backups",
+    "interval",
+    "compression_level",
+    "compression_threads",
+    "compression_budget",
+    "compression_cpu_budget",
+    "dictionary",
+    "dictionary_size",
+    "full_backup_every",
+    "restore_threads",
+    "move_threads",
+    "catalog",
+    "restore_priority",
+    "priority",
+    "promote_threshold",
+    "demote_after",
+    "tier_interval",
+    "tier_size",
+}
+
 
 class Target:
     def __init__(
@@ -15,8 +38,30 @@ class Target:
         backup_path: str,
         max_backups: int,
         interval: dict,
-        compression_level: int,
+        compression_level: Union[int, str],
         compression_threads: int,
+        compression_budget: float,
+        compression_cpu_budget: float,
+        dictionary: bool,
+        dictionary_size: int,
+        full_backup_every: int,
+        backend: str,
+        chunk_store: Path,
+        restore_threads: int,
+        move_threads: int,
+        shutdown_mode: str,
+        snapshot: bool,
+        exclude: list,
+        include: list,
+        catalog: bool,
+        lazy_restore: bool,
+        restore_priority: list,
+        priority: int,
+        tiered: bool,
+        promote_threshold: int,
+        demote_after: int,
+        tier_interval: int,
+        tier_size: int,
         ram_path: Path,
     ):
         self.name = name
@@ -27,10 +72,37 @@ class Target:
             self.backup_path = Path(os.path.expandvars(backup_path)).expanduser()
         self.interval = interval
         self.max_backups = max_backups
+        _check_compression_level(compression_level)
         self.compression_level = compression_level
         self.compression_threads = compression_threads
+        self.compression_budget = compression_budget
+        self.compression_cpu_budget = compression_cpu_budget
+        self.dictionary = dictionary
+        self.dictionary_size = dictionary_size
+        self.full_backup_every = max(full_backup_every, 1)
+        if backend not in ("tar", "chunks"):
+            raise ValueError(f"Unknown backup backend: {backend}")
+        self.backend = backend
+        self.chunk_store = chunk_store
+        self.restore_threads = restore_threads
+        self.move_threads = move_threads
+        if shutdown_mode not in ("copy", "sync", "discard"):
+            raise ValueError(f"Unknown shutdown mode: {shutdown_mode}")
+        self.shutdown_mode = "copy" if tiered else shutdown_mode
+        self.snapshot = snapshot
+        self.path_filter = PathFilter(exclude, include)
+        self.catalog = catalog
+        self.lazy_restore = lazy_restore and not tiered
+        self.restore_priority = restore_priority
+        self.priority = priority
+        self.tiered = tiered
+        self.promote_threshold = max(promote_threshold, 1)
+        self.demote_after = max(demote_after, 1)
+        self.tier_interval = tier_interval
+        self.tier_size = tier_size
 
         self.ram_path = ram_path
+        self.data_path = ram_path if tiered else self.path
 
         if self.path.is_symlink() and self.path.resolve() == self.ram_path:
             self.path.unlink()
@@ -40,3 +112,20 @@ class Target:
 
         ensure_dir(self.path)
         ensure_dir(self.backup_path)
+        if self.tiered:
+            ensure_dir(self.ram_path, 0o700)
+
+    def update(self, options: dict):
+        if "compression_level" in options:
+            _check_compression_level(options["compression_level"])
+        for key, value in options.items():
+            setattr(self, key, value)
+
+        self.full_backup_every = max(self.full_backup_every, 1)
+        self.promote_threshold = max(self.promote_threshold, 1)
+        self.demote_after = max(self.demote_after, 1)
+
+
+def _check_compression_level(compression_level: Union[int, str]):
+    if compression_level != "auto" and not isinstance(compression_level, int):
+        raise ValueError(f"Invalid compression level: {compression_level}")
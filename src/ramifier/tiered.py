@@ -0,0 +1,285 @@
+import os
+import shutil
+import stat
+from collections import Counter
+from pathlib import Path
+from threading import Lock
+
+from .changes import ChangeDetector, get_detector
+from .log import log_info, log_warning
+from .scheduler import Scheduler
+from .target import Target
+from .utils import ensure_dir
+
+SHADOW_DIR = ".ramifier-tier"
+
+
+class Tier:
+    def __init__(self, target: Target, scheduler: Scheduler):
+        self.target = target
+        self.scheduler = scheduler
+        self.disk = ChangeDetector(target.path, target.name, track_access=True)
+        self.shadow_path = target.path / SHADOW_DIR
+
+        self._job = None
+        self._lock = Lock()
+        self._disk_accesses = Counter()
+        self._ram_accesses = Counter()
+        self._idle = Counter()
+        self._hot = {}
+
+    def start(self):
+        ensure_dir(self.target.ram_path, 0o700)
+        os.chmod(self.target.ram_path, 0o700)
+        self._repair()
+        self.disk.refresh()
+        self._disk_accesses = self.disk.access_counts()
+        self._ram_accesses = get_detector(self.target).access_counts()
+        self._schedule()
+        log_info(f"Tiered storage started: {self.target.ram_path}", self.target.name)
+
+    def stop(self):
+        if self._job is not None:
+            self.scheduler.cancel(self._job)
+
+        with self._lock:
+            ram = get_detector(self.target)
+            ram.refresh()
+            for rel in ram.files():
+                if not self._demote(rel) and self._is_linked(rel):
+                    self._demote(rel)
+
+            _remove_empty_dirs(self.target.ram_path)
+            _remove_empty_dirs(self.shadow_path)
+            self.disk.close()
+
+        if self.target.ram_path.exists():
+            log_warning(
+                f"Files left in RAM tier: {self.target.ram_path}", self.target.name
+            )
+        log_info("Tiered storage stopped", self.target.name)
+
+    def release_shadows(self):
+        with self._lock:
+            dirty = get_detector(self.target).dirty_paths()
+            for rel in self._shadows():
+                if rel not in dirty and self._is_linked(rel):
+                    (self.shadow_path / rel).unlink(missing_ok=True)
+
+    def _shadows(self) -> list[str]:
+        shadows = []
+        for dir_path, _, file_names in os.walk(self.shadow_path):
+            for name in file_names:
+                shadows.append(
+                    os.path.relpath(os.path.join(dir_path, name), self.shadow_path)
+                )
+        return shadows
+
+    def _repair(self):
+        repaired = 0
+        for rel in self._shadows():
+            shadow = self.shadow_path / rel
+            if self._is_linked(rel) and not (self.target.ram_path / rel).exists():
+                os.replace(shadow, self.target.path / rel)
+                repaired += 1
+            elif not self._is_linked(rel):
+                shadow.unlink()
+
+        if repaired:
+            log_warning(
+                f"Recovered {repaired} files missing from the RAM tier",
+                self.target.name,
+            )
+
+    def _schedule(self):
+        self._job = self.scheduler.schedule(
+            self.target.tier_interval,
+            self._migrate,
+            self.target.priority,
+            self.target.name,
+        )
+
+    def _migrate(self):
+        try:
+            with self._lock:
+                self._migrate_files()
+        finally:
+            self._schedule()
+
+    def _migrate_files(self):
+        ram = get_detector(self.target)
+        disk_accesses = self.disk.access_counts()
+        ram_accesses = ram.access_counts()
+        hot_files = ram.files()
+        disk_files = self.disk.files()
+        disk_delta = disk_accesses - self._disk_accesses
+        ram_delta = ram_accesses - self._ram_accesses
+        self._disk_accesses = disk_accesses
+        self._ram_accesses = ram_accesses
+
+        idle = []
+        for rel, entry in hot_files.items():
+            if not self._is_linked(rel):
+                (self.target.ram_path / rel).unlink(missing_ok=True)
+                (self.shadow_path / rel).unlink(missing_ok=True)
+                self._idle.pop(rel, None)
+                continue
+
+            modified = self._hot.get(rel) != entry[:2]
+            self._idle[rel] = 0 if ram_delta[rel] or modified else self._idle[rel] + 1
+            if self._idle[rel] >= self.target.demote_after:
+                idle.append(rel)
+        self._hot = {rel: entry[:2] for rel, entry in hot_files.items()}
+
+        demoted = 0
+        writing = _open_for_writing(self.target.ram_path, idle)
+        for rel in idle:
+            if rel not in writing and self._demote(rel):
+                demoted += 1
+
+        promoted = 0
+        tier_size = sum(entry[0] for entry in hot_files.values())
+        tier_limit = self.target.tier_size * 1024 * 1024
+        candidates = [
+            rel
+            for rel, count in disk_delta.most_common()
+            if count >= self.target.promote_threshold
+            and rel not in hot_files
+            and rel in disk_files
+            and not rel.startswith(SHADOW_DIR)
+        ]
+        writing = _open_for_writing(self.target.path, candidates)
+        for rel in candidates:
+            if rel in writing:
+                continue
+
+            size = disk_files[rel][0]
+            if tier_limit and tier_size + size > tier_limit:
+                continue
+            if self._promote(rel):
+                promoted += 1
+                tier_size += size
+
+        if promoted or demoted:
+            log_info(
+                f"Tier migration: {promoted} promoted, {demoted} demoted",
+                self.target.name,
+            )
+
+    def _is_linked(self, rel: str) -> bool:
+        link = self.target.path / rel
+        return link.is_symlink() and os.readlink(link) == str(
+            self.target.ram_path / rel
+        )
+
+    def _promote(self, rel: str) -> bool:
+        src = self.target.path / rel
+        dst = self.target.ram_path / rel
+        try:
+            src_stat = os.lstat(src)
+            if not stat.S_ISREG(src_stat.st_mode):
+                return False
+
+            ensure_dir(dst.parent)
+            shutil.copy2(src, dst)
+            if _changed(src, src_stat):
+                dst.unlink()
+                return False
+
+            shadow = self.shadow_path / rel
+            ensure_dir(shadow.parent)
+            shadow.unlink(missing_ok=True)
+            os.link(src, shadow)
+
+            link = src.with_name(f".{src.name}.ramifier-link")
+            os.symlink(dst, link)
+            os.replace(link, src)
+            self._idle[rel] = 0
+            return True
+
+        except OSError as e:
+            log_warning(f"Failed to promote {rel}: {e}", self.target.name)
+            return False
+
+    def _demote(self, rel: str) -> bool:
+        src = self.target.ram_path / rel
+        dst = self.target.path / rel
+        if not self._is_linked(rel):
+            src.unlink(missing_ok=True)
+            return False
+
+        temp_file = dst.with_name(f".{dst.name}.ramifier-tmp")
+        try:
+            src_stat = os.lstat(src)
+            shutil.copy2(src, temp_file)
+            if _changed(src, src_stat):
+                temp_file.unlink()
+                return False
+
+            os.replace(temp_file, dst)
+            src.unlink()
+            (self.shadow_path / rel).unlink(missing_ok=True)
+            self._idle.pop(rel, None)
+            return True
+
+        except OSError as e:
+            temp_file.unlink(missing_ok=True)
+            log_warning(f"Failed to demote {rel}: {e}", self.target.name)
+            return False
+
+
+def _changed(path: Path, old_stat: os.stat_result) -> bool:
+    new_stat = os.lstat(path)
+    return (new_stat.st_size, new_stat.st_mtime_ns) != (
+        old_stat.st_size,
+        old_stat.st_mtime_ns,
+    )
+
+
+def _open_for_writing(root: Path, paths: list) -> set:
+    inodes = {}
+    for rel in paths:
+        try:
+            path_stat = os.lstat(root / rel)
+        except OSError:
+            continue
+        inodes[(path_stat.st_dev, path_stat.st_ino)] = rel
+    if not inodes:
+        return set()
+
+    writing = set()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            fds = os.listdir(f"/proc/{pid}/fd")
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                fd_stat = os.stat(f"/proc/{pid}/fd/{fd}")
+            except OSError:
+                continue
+            rel = inodes.get((fd_stat.st_dev, fd_stat.st_ino))
+            if rel is not None and rel not in writing and _writable(pid, fd):
+                writing.add(rel)
+    return writing
+
+
+def _writable(pid: str, fd: str) -> bool:
+    try:
+        with open(f"/proc/{pid}/fdinfo/{fd}") as f_in:
+            for line in f_in:
+                if line.startswith("flags:"):
+                    return int(line.split()[1], 8) & os.O_ACCMODE != os.O_RDONLY
+    except (OSError, ValueError):
+        pass
+    return False
+
+
+def _remove_empty_dirs(path: Path):
+    for dir_path, _, _ in sorted(os.walk(path), key=lambda w: w[0], reverse=True):
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            continue
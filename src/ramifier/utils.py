@@ -1,9 +1,17 @@
 import hashlib
+import os
 from datetime import datetime
 from pathlib import Path
+from threading import Lock
+from time import monotonic
 
 from psutil import disk_partitions
 
+MOUNTS_TTL = 60
+
+_MOUNTS = None
+_MOUNTS_LOCK = Lock()
+
 
 def current_timestamp() -> str:
     return datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -11,11 +19,10 @@ def current_timestamp() -> str:
 
 def is_tmpfs(path: Path) -> bool:
     path = str(path.resolve())
-    partitions = sorted(
-        disk_partitions(all=True), key=lambda p: len(p.mountpoint), reverse=True
-    )
-    for part in partitions:
-        if path.startswith(part.mountpoint):
+    for part in _partitions():
+        if path == part.mountpoint or path.startswith(
+            part.mountpoint.rstrip("/") + "/"
+        ):
             return part.fstype == "tmpfs"
     return False
 
@@ -41,21 +48,34 @@ def get_file_hash(path: Path) -> str:
     return sha256_hasher.hexdigest()
 
 
-def get_tree_state_hash(path: Path) -> str:
-    sha256_hasher = hashlib.sha256()
-    for item in sorted(path.rglob("*")):
-        if not item.is_file():
-            continue
-
+def _partitions() -> list:
+    global _MOUNTS
+    now = monotonic()
+    with _MOUNTS_LOCK:
+        if _MOUNTS is None or now - _MOUNTS[0] > MOUNTS_TTL:
+            partitions = sorted(
+                disk_partitions(all=True),
+                key=lambda p: len(p.mountpoint),
+                reverse=True,
+            )
+            _MOUNTS = (now, partitions)
+        return _MOUNTS[1]
+
+
+def get_tree_size(path: Path) -> int:
+    size = 0
+    stack = [str(path)]
+    while stack:
         try:
-            stat = item.stat()
-        except (FileNotFoundError, PermissionError):
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
             continue
-
-        sha256_hasher.update(str(item.relative_to(path)).encode())
-        sha256_hasher.update(str(int(stat.st_mtime)).encode())
-
-    return sha256_hasher.hexdigest()
+    return size
 
 
 def ensure_dir(path: Path, mode: int = None):
@@ -0,0 +1,77 @@
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from time import process_time
+
+from .log import set_log_format
+from .scheduler import LIMITS, PriorityGate
+
+
+class Workers:
+    def __init__(self):
+        self._pool = None
+        self._gate = None
+        self._settings = None
+        self._lock = Lock()
+
+    def configure(self, executor: str, max_jobs: int, io_limit: int, log_format: str):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown executor: {executor}")
+
+        settings = (executor, max_jobs, io_limit, log_format)
+        with self._lock:
+            if settings == self._settings:
+                return
+            old_pool = self._pool
+            self._settings = settings
+            self._pool = None
+            self._gate = None
+            if executor == "process":
+                workers = max_jobs or os.cpu_count() or 1
+                self._gate = PriorityGate(workers)
+                self._pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(io_limit // workers, log_format),
+                )
+
+        if old_pool is not None:
+            old_pool.shutdown(wait=False)
+
+    def run(self, priority: int, fn, *args) -> tuple:
+        with self._lock:
+            pool = self._pool
+            gate = self._gate
+
+        if pool is None:
+            return _timed(fn, *args)
+        with gate.acquire(priority):
+            return pool.submit(_timed, fn, *args).result()
+
+    def stop(self):
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+            self._gate = None
+            self._settings = None
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def _init_worker(io_limit: int, log_format: str):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    LIMITS.configure(0, io_limit)
+    set_log_format(log_format)
+
+
+def _timed(fn, *args) -> tuple:
+    started = process_time()
+    result = fn(*args)
+    return result, process_time() - started
+
+
+WORKERS = Workers()